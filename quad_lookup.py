@@ -0,0 +1,309 @@
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+from quadtree import locate_leaf, bilinear_coefficients
+
+# The 9 properties of the tables (see utility.get_coolprop_TPS), the energies,
+# entropies and heat capacities are in kJ/kg(K) while the table variables are
+# in SI units (e, h in J/kg, s in J/kg/K). The h-P, s-P (and T-P) tables give
+# rho and e directly for these input pairs, e in kJ/kg: it is 1000 times e
+# on the axis of the rho-e table.
+properties = {'T-P': ['rho', 'e', 'h', 's', 'cv', 'cp', 'a', 'mu', 'k'],
+              'rho-e': ['T', 'P', 'h', 's', 'cv', 'cp', 'a', 'mu', 'k'],
+              'h-P': ['rho', 'e', 'T', 's', 'cv', 'cp', 'a', 'mu', 'k'],
+              's-P': ['rho', 'e', 'T', 'h', 'cv', 'cp', 'a', 'mu', 'k']}
+
+class QuadTable():
+    #_______________________________________________________
+    # A table written by QuadTree (quad_list_leaves.pickle) for lookups of
+    # arrays of states: the leaves are found from the Morton codes of the
+    # table (locate_leaf()) and interpolated at array level, "batch" points
+    # at a time so the work arrays stay small for fields of millions of cells.
+    #   rect[i]    minx, minz, maxx, maxz of leaf i in the transformed domain
+    #   coef[:, :, i]  the coefficients a, b, c, d of its bilinear interpolant
+    #              a + b*dx + c*dz + d*dx*dz of the 9 properties, (dx, dz)
+    #              from its BL corner (see bilinear_coefficients())
+    batch = 65536
+
+    def __init__(self, table="quad_list_leaves.pickle", response="rho-e"):
+        f=open(table, "rb" )
+        quad_list_leaves, quad_list_unit, quad_list_index, quad_list_depth, leaf_code, leaf_of, trans, maxdepth = pickle.load(f)
+        f.close()
+        self.response = response
+        self.properties = properties[response]
+        self.trans = trans
+        self.maxdepth = maxdepth
+        self.leaf_code = leaf_code
+        self.leaf_of = leaf_of
+        self.index = np.array(quad_list_index, dtype=np.int64)
+        self.rect = np.array([item[0] for item in quad_list_unit], dtype=float)
+        prop = np.array([[item[1], item[2], item[4], item[3]] for item in quad_list_unit], dtype=float)
+        self.coef = bilinear_coefficients(self.rect, prop)
+        # the range of the table variables (x, z) covered by the table
+        corners = trans.inverse([[np.min(self.rect[:, 0]), np.min(self.rect[:, 1])], [np.max(self.rect[:, 2]), np.max(self.rect[:, 3])]])
+        self.bounds = (np.min(corners[:, 0]), np.min(corners[:, 1]), np.max(corners[:, 0]), np.max(corners[:, 1]))
+        self.start_trees = {} # see start()
+
+    #_______________________________________________________
+    # The leaves of the states (x, z) of the table variables (rho and e, or T
+    # and P), scalars or arrays of any shape, and the coordinates (dx, dz) of
+    # the states from the BL corners of their leaves in the transformed domain.
+    # These handles (leaf, dx, dz) are given to evaluate(), as many times as
+    # needed, for the properties at the same states.
+    # States outside the table are extrapolated from the leaf at its edge.
+    def locate(self, x, z):
+        x, z = np.broadcast_arrays(np.asarray(x, dtype=float), z)
+        leaf = np.empty(x.shape, dtype=np.int32)
+        dx = np.empty(x.shape)
+        dz = np.empty(x.shape)
+        x_f = x.ravel()
+        z_f = z.ravel()
+        leaf_f = leaf.reshape(-1)
+        dx_f = dx.reshape(-1)
+        dz_f = dz.reshape(-1)
+        for start in range(0, len(x_f), self.batch):
+            end = start + self.batch
+            xu, zu = self.trans(np.column_stack((x_f[start:end], z_f[start:end]))).T
+            leaf_f[start:end] = locate_leaf(self.leaf_code, self.leaf_of, self.maxdepth, xu, zu)
+            dx_f[start:end] = xu - self.rect[leaf_f[start:end], 0]
+            dz_f[start:end] = zu - self.rect[leaf_f[start:end], 1]
+        return leaf, dx, dz
+
+    # The properties (names of self.properties or their positions, all of
+    # them by default) at the states of the handles from locate(). Returns an
+    # array of the properties, of the shape of the states, e.g.
+    #   P, T = table.evaluate(handles, ['P', 'T'])
+    # or that of the state when "properties" is a single name.
+    def evaluate(self, handles, properties=None):
+        leaf, dx, dz = handles
+        if properties is None:
+            properties = range(9)
+        names = properties
+        if isinstance(properties, str):
+            names = [properties]
+        names = [self.properties.index(name) if isinstance(name, str) else name for name in names]
+        coef = self.coef
+        if names != range(9):
+            coef = self.coef[:, names]
+        data = np.empty((len(names),) + leaf.shape)
+        leaf_f = leaf.reshape(-1)
+        dx_f = dx.reshape(-1)
+        dz_f = dz.reshape(-1)
+        data_f = data.reshape(len(names), -1)
+        for start in range(0, len(leaf_f), self.batch):
+            end = start + self.batch
+            bil = data_f[:, start:end]
+            np.multiply(np.take(coef[3], leaf_f[start:end], axis=1), dz_f[start:end], out=bil)
+            bil += np.take(coef[1], leaf_f[start:end], axis=1)
+            bil *= dx_f[start:end]
+            bil += np.take(coef[0], leaf_f[start:end], axis=1)
+            bil += np.take(coef[2], leaf_f[start:end], axis=1)*dz_f[start:end]
+        if isinstance(properties, str):
+            return data[0]
+        return data
+
+    # The partial derivatives of the properties (as in evaluate()) with
+    # respect to the table variables x and z (rho and e, or T and P), from the
+    # interpolants of the leaves and the derivatives of the transform to the
+    # unit square. Returns an array (properties, 2, states), e.g.
+    #   (dPdrho, dPde), (dTdrho, dTde) = table.derivatives(handles, ['P', 'T'])
+    # in the units of the properties over those of the table variables. They
+    # are constant across a leaf in x for d/dx and in z for d/dz.
+    def derivatives(self, handles, properties=None):
+        leaf, dx, dz = handles
+        if properties is None:
+            properties = range(9)
+        names = properties
+        if isinstance(properties, str):
+            names = [properties]
+        names = [self.properties.index(name) if isinstance(name, str) else name for name in names]
+        coef = self.coef
+        if names != range(9):
+            coef = self.coef[:, names]
+        H = self.trans.params
+        data = np.empty((len(names), 2) + leaf.shape)
+        leaf_f = leaf.reshape(-1)
+        dx_f = dx.reshape(-1)
+        dz_f = dz.reshape(-1)
+        data_f = data.reshape(len(names), 2, -1)
+        for start in range(0, len(leaf_f), self.batch):
+            end = start + self.batch
+            leaf_b = leaf_f[start:end]
+            dx_b = dx_f[start:end]
+            dz_b = dz_f[start:end]
+            # the derivatives of the transform x, z -> xu, zu at the states
+            xu = self.rect[leaf_b, 0] + dx_b
+            zu = self.rect[leaf_b, 1] + dz_b
+            x, z = self.trans.inverse(np.column_stack((xu, zu))).T
+            w = H[2, 0]*x + H[2, 1]*z + H[2, 2]
+            xu_x = (H[0, 0] - xu*H[2, 0])/w
+            xu_z = (H[0, 1] - xu*H[2, 1])/w
+            zu_x = (H[1, 0] - zu*H[2, 0])/w
+            zu_z = (H[1, 1] - zu*H[2, 1])/w
+            # the derivatives of the interpolants in the unit square
+            d = np.take(coef[3], leaf_b, axis=1)
+            f_xu = np.take(coef[1], leaf_b, axis=1) + d*dz_b
+            f_zu = np.take(coef[2], leaf_b, axis=1) + d*dx_b
+            data_f[:, 0, start:end] = f_xu*xu_x + f_zu*zu_x
+            data_f[:, 1, start:end] = f_xu*xu_z + f_zu*zu_z
+        if isinstance(properties, str):
+            return data[0]
+        return data
+
+    # All the properties at the states (x, z), see locate(), e.g.
+    #   T, P, h, s, cv, cp, a, mu, k = table.lookup(rho, e)
+    def lookup(self, x, z):
+        return self.evaluate(self.locate(x, z))
+
+    #_______________________________________________________
+    # The states (x, z) of the table variables (rho and e for a rho-e table)
+    # where two of the properties ("names", P and T by default) take the
+    # values f0 and f1, arrays of any shape. Newton iterations with the
+    # derivatives of the interpolants (derivatives()), from x0, z0 (by default
+    # the centres of the leaves closest in f0, f1, see start()) and kept
+    # inside the table. Each state iterates
+    # until both its residuals are within "tol" of the targets (relative) or
+    # until max_iterations, only the states that have not converged are
+    # located and evaluated again. Returns x, z and whether each converged.
+    def invert(self, f0, f1, names=['P', 'T'], x0=None, z0=None, tol=1.0E-10, max_iterations=50):
+        xmin, zmin, xmax, zmax = self.bounds
+        if x0 is None or z0 is None:
+            x0, z0 = self.start(f0, f1, names)
+        f0, f1, x0, z0 = np.broadcast_arrays(np.asarray(f0, dtype=float), f1, x0, z0)
+        shape = f0.shape
+        f0 = f0.ravel()
+        f1 = f1.ravel()
+        x = np.array(x0, dtype=float).ravel()
+        z = np.array(z0, dtype=float).ravel()
+        converged = np.zeros(len(f0), dtype=bool)
+        active = np.arange(len(f0))
+        for iteration in range(max_iterations + 1):
+            if len(active) == 0:
+                break
+            handles = self.locate(x[active], z[active])
+            r0, r1 = self.evaluate(handles, names) - [f0[active], f1[active]]
+            done = (np.abs(r0) <= tol*np.abs(f0[active])) & (np.abs(r1) <= tol*np.abs(f1[active]))
+            converged[active[done]] = True
+            if iteration == max_iterations:
+                break
+            active = active[~done]
+            handles = tuple(h[~done] for h in handles)
+            r0 = r0[~done]
+            r1 = r1[~done]
+            (f0_x, f0_z), (f1_x, f1_z) = self.derivatives(handles, names)
+            det = f0_x*f1_z - f0_z*f1_x
+            # no step for a singular jacobian, the state is given up
+            regular = det != 0
+            active = active[regular]
+            det = det[regular]
+            dx = (f1_z[regular]*r0[regular] - f0_z[regular]*r1[regular])/det
+            dz = (f0_x[regular]*r1[regular] - f1_x[regular]*r0[regular])/det
+            x[active] = np.clip(x[active] - dx, xmin, xmax)
+            z[active] = np.clip(z[active] - dz, zmin, zmax)
+        return x.reshape(shape), z.reshape(shape), converged.reshape(shape)
+
+    #_______________________________________________________
+    # The states on the line of the table variable x (axis 0, e.g. rho) or z
+    # (axis 1, e.g. e) at "value" where the property "name" takes the value f,
+    # e.g. the energies of given densities and pressures
+    #   e, found = table.invert_along(rho, P, 'P', 0)
+    # for arrays of any shape. The table variables are taken along the axes
+    # of the transformed domain, so on the line the interpolant of a leaf is
+    # linear in the unknown and is solved directly. The leaves on the line
+    # are walked up (right) from the bottom (left) of the table, or from
+    # "guess" of the unknown and then down (left) from it, until the first
+    # one that holds the value, as the value may be taken more than once.
+    # Returns the other table variable (NaN where the value is not found on
+    # the line) and whether it was found.
+    # This needs a transform that maps the axes of the table to those of the
+    # transformed domain (scaling and shift only, e.g. rho-e), otherwise the
+    # table variable moves along the line and ValueError is raised (e.g. the
+    # T-P table, whose transform is projective; use invert() there).
+    def invert_along(self, value, f, name='P', axis=0, guess=None):
+        if isinstance(name, str):
+            name = self.properties.index(name)
+        other = 1 - axis
+        x0,z0,x1,z1 = self.bounds
+        # the change of the transform over the table from its off-diagonal terms
+        p = self.trans.params
+        if abs(p[2, 0])*(x1 - x0) + abs(p[2, 1])*(z1 - z0) > 1.0E-9*abs(p[2, 2]) or abs(p[0, 1])*(z1 - z0) > 1.0E-9*abs(p[0, 0])*(x1 - x0) or abs(p[1, 0])*(x1 - x0) > 1.0E-9*abs(p[1, 1])*(z1 - z0):
+            raise ValueError('the transform of the table is not aligned with its axes, use invert()')
+        guess_given = guess is not None
+        if guess_given == False:
+            guess = [x0, z0][other]
+        value, f, guess = np.broadcast_arrays(np.asarray(value, dtype=float), f, guess)
+        shape = value.shape
+        point = np.empty((value.size, 2))
+        point[:, axis] = value.ravel()
+        point[:, other] = guess.ravel()
+        f = f.ravel()
+        fixed, position = self.trans(point).T[[axis, other]]
+        low = np.min(self.rect[:, other])
+        high = np.max(self.rect[:, other + 2])
+        position = np.clip(position, low, high)
+        half = (high - low)/2**(self.maxdepth + 1) # half the finest cell
+        unit = np.full(len(f), np.nan)
+        found = np.zeros(len(f), dtype=bool)
+        a, b, c, d = self.coef[:, name]
+        guessed = position.copy()
+        for direction in [1, -1]:
+            active = np.nonzero(~found)[0]
+            if direction == -1:
+                if guess_given == False:
+                    break
+                # the walk down starts below the leaf of the guess
+                xu = [fixed[active], guessed[active]][axis]
+                zu = [guessed[active], fixed[active]][axis]
+                start = self.rect[locate_leaf(self.leaf_code, self.leaf_of, self.maxdepth, xu, zu), other]
+                position[active] = start - half
+                active = active[start > low]
+            while len(active) > 0:
+                xu = [fixed[active], position[active]][axis]
+                zu = [position[active], fixed[active]][axis]
+                leaf = locate_leaf(self.leaf_code, self.leaf_of, self.maxdepth, xu, zu)
+                rect = self.rect[leaf]
+                start = rect[:, other]
+                length = rect[:, other + 2] - start
+                offset = fixed[active] - rect[:, axis]
+                if axis == 0:
+                    base = a[leaf] + b[leaf]*offset
+                    slope = c[leaf] + d[leaf]*offset
+                else:
+                    base = a[leaf] + c[leaf]*offset
+                    slope = b[leaf] + d[leaf]*offset
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    t = np.where(slope != 0, (f[active] - base)/slope, np.where(base == f[active], 0.0, -1.0))
+                    solved = (t >= 0) & (t <= length)
+                unit[active[solved]] = start[solved] + t[solved]
+                found[active[solved]] = True
+                if direction == 1:
+                    position[active] = start + length
+                    active = active[~solved & (start + length < high)]
+                else:
+                    position[active] = start - half
+                    active = active[~solved & (start > low)]
+        point[:, other] = np.nan
+        point[found, other] = self.trans.inverse(np.column_stack([[fixed[found], unit[found]], [unit[found], fixed[found]]][axis]))[:, other]
+        return point[:, other].reshape(shape), found.reshape(shape)
+
+    # The centres (x, z) of the leaves whose values of the properties "names"
+    # at their centres are closest to f0, f1 (relative to their ranges over
+    # the table), as starting states for invert(). The centres are kept in a
+    # k-d tree for each pair of properties.
+    def start(self, f0, f1, names):
+        key = tuple(names)
+        if key not in self.start_trees:
+            xc = (self.rect[:, 0] + self.rect[:, 2])/2
+            zc = (self.rect[:, 1] + self.rect[:, 3])/2
+            handles = (np.arange(len(self.rect)), xc - self.rect[:, 0], zc - self.rect[:, 1])
+            values = self.evaluate(handles, names).T
+            scale = np.ptp(values, axis=0)
+            scale[scale == 0] = 1.0
+            # one centre for the leaves with the same values (e.g. those bound
+            # to the critical point), these would slow the searches down
+            values, first = np.unique(values, axis=0, return_index=True)
+            self.start_trees[key] = (cKDTree(values/scale), scale, self.trans.inverse(np.column_stack((xc[first], zc[first]))))
+        tree, scale, centres = self.start_trees[key]
+        f0, f1 = np.broadcast_arrays(np.asarray(f0, dtype=float), f1)
+        distance, leaf = tree.query(np.column_stack((f0.ravel(), f1.ravel()))/scale)
+        return centres[leaf, 0].reshape(f0.shape), centres[leaf, 1].reshape(f0.shape)
@@ -14,11 +14,12 @@ from CoolProp.CoolProp import PropsSI
 import numpy as np
 import matplotlib.cm as cm
 from skimage.transform import ProjectiveTransform
+from quadtree import locate_leaf
 
 fluid = 'Oxygen'
 response = raw_input("Enter the coordinates type T-P or rho-e: ")
 f = open("quad_list_leaves.pickle", "rb")
-quad_list_leaves, quad_list_unit, quad_list_index, quad_list_depth, uni_old, ind_file, trans, max_depth= pickle.load(f)
+quad_list_leaves, quad_list_unit, quad_list_index, quad_list_depth, leaf_code, leaf_of, trans, max_depth= pickle.load(f)
 f = open("quad_list_rect.pickle", "rb")
 quad_list_rect, quad_list_uindex = pickle.load(f)
 figsuffix = "/home/administrator/Desktop/Tabulated_EoS/plot"
@@ -113,17 +114,8 @@ def bilinear_interpolation(x, y, points):
     return prop_array
 
 def get_tableprops(rho, Eint_mass, key):
-    drho = 1024/(2**max_depth)
-    de   = 1024/(2**max_depth)
     rho, Eint_mass = np.ndarray.tolist(trans([rho, Eint_mass])[0])
-    idx  = np.floor((rho-0)/drho)
-    idx  = idx.astype(int)
-    idy  = np.floor((Eint_mass-0)/de)
-    idy  = idy.astype(int)
-
-    n1 = int(uni_old[idy][idx])
-    n1 = int(ind_file[n1])
-    n1 = [i for i,x in enumerate(quad_list_index) if x == n1][0]
+    n1 = int(locate_leaf(leaf_code, leaf_of, max_depth, rho, Eint_mass))
     data = quad_list_unit[n1]
 
     rect = data[0] # rho-e rectangle / box in which the point lies
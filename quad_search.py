@@ -3,9 +3,10 @@ import pickle
 from pdb import set_trace as keyboard
 import matplotlib.pyplot as plt
 from skimage.transform import ProjectiveTransform
+from quadtree import finest_leaf
 
 f = open("quad_list_leaves.pickle", "rb")
-quad_list_leaves, quad_list_unit, quad_list_index, quad_list_depth, uni_old, ind_file = pickle.load(f)
+quad_list_leaves, quad_list_unit, quad_list_index, quad_list_depth, leaf_code, leaf_of, trans, max_depth = pickle.load(f)
 response = raw_input("Enter the coordinates type T-P or rho-e: ")
 rootrect = [0.14, -70793, 1305.20, 600000]
 
@@ -99,9 +100,7 @@ if response == "rho-e":
 	idy  = idy.astype(int)
 
 	print "indexes are, ", idx, idy
-	n1 = int(uni_old[idx-1][idy-1])
-	n1 = ind_file[n1+1]
-	n1 = [i for i,x in enumerate(quad_list_index) if x == n1][0]
+	n1 = int(finest_leaf(leaf_code, leaf_of, idy-1, idx-1))
 
 	data = quad_list_leaves[n1]
 	print data
@@ -2,9 +2,12 @@ import NIST_reader as NIST
 import numpy as np
 from CoolProp.CoolProp import PropsSI
 from CoolProp.CoolProp import PhaseSI
+from CoolProp.CoolProp import AbstractState
+import CoolProp.CoolProp as CP
 from pdb import set_trace as keyboard
 from skimage.transform import ProjectiveTransform
 import unicodedata
+import threading
 
 
 # def get_dataNIST(x_mid, z_mid):
@@ -15,144 +18,227 @@ import unicodedata
 #     return dataNIST
 
 def get_coolprop_TPS(x_mid, z_mid, response,trans, fluid='Oxygen'):
-    dataCoolProp =[]
-
     ####------------------In Temperature-Pressure space ------------####
-    if response == "T-P":
-        [x_mid, z_mid] = np.ndarray.tolist(trans.inverse([x_mid, z_mid])[0])
-
-        data_density = PropsSI('DMASS', 'P', z_mid,'T', x_mid, fluid)
-        #data_volume = 0
-        data_internal_energy = PropsSI('UMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-        data_enthalpy= PropsSI('HMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-        data_entropy= PropsSI('SMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-        data_cv = PropsSI('CVMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-        data_cp = PropsSI('CPMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-        data_a = PropsSI('A', 'P', z_mid,'T', x_mid, fluid)
-        #data_joule = 0
-        data_mu= PropsSI('VISCOSITY', 'P', z_mid,'T', x_mid, fluid)
-        data_k = PropsSI('CONDUCTIVITY', 'P', z_mid,'T', x_mid, fluid)
-        data_phase = PropsSI('PHASE', 'P', z_mid,'T', x_mid, fluid)
-        #data = [data_density, data_volume, data_internal_energy, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_joule, data_mu, data_k, data_phase]
-        data = [data_density, data_internal_energy, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_mu, data_k]
-        dataCoolProp.append(data)
-
+    # [rho, e, h, s, cv, cp, a, mu, k]
     ####------------------In Density-Int. energy space---------------####
-    elif response == "rho-e":
-
-        [x_mid, z_mid] = np.ndarray.tolist(trans.inverse([x_mid, z_mid])[0])
-        data_phase = PhaseSI('UMASS', z_mid,'DMASS', x_mid, fluid)
-        data_phase = unicodedata.normalize('NFKD', data_phase).encode('ascii','ignore')
-        if data_phase == 'twophase':
-            x_mid = 460.5914052903932
-            z_mid = 17667.19156915298
-        if data_phase == '':
-            x_mid = 460.5914052903932
-            z_mid = 17667.19156915298
-        # if data_phase != 'supercritical':
-        #     x_mid = 460.5914052903932 
-        #     z_mid = 17667.19156915298
- 
-        data_temp = PropsSI('T', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-        data_volume = 0
-        data_pressure = PropsSI('P', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-        data_enthalpy= PropsSI('HMASS', 'UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0
-        data_entropy= PropsSI('SMASS','UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0
-        data_cv = PropsSI('CVMASS','UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0
-        data_cp = PropsSI('CPMASS', 'UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0
-        data_a = PropsSI('A', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-        #data_joule = 0
-        data_mu= PropsSI('VISCOSITY', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-        data_k = PropsSI('CONDUCTIVITY', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-        
-        #data = [data_density, data_volume, data_internal_energy, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_joule, data_mu, data_k, data_phase]
-        data = [data_temp, data_pressure, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_mu, data_k]
-        dataCoolProp.append(data)
-    return dataCoolProp[0]
+    # [T, P, h, s, cv, cp, a, mu, k], two-phase states are bound to critical properties
+    ####------------------In Enthalpy-Pressure space-----------------####
+    # [rho, e, T, s, cv, cp, a, mu, k]
+    ####------------------In Entropy-Pressure space------------------####
+    # [rho, e, T, h, cv, cp, a, mu, k], in both of them two-phase states are
+    # mixtures with cv, cp, a, mu, k bound to critical properties
+    return np.ndarray.tolist(get_coolprop_batch([x_mid], [z_mid], response, trans, fluid)[0])
 
 
 def get_coolprop_TP(pointp, response, trans, fluid='Oxygen'):
-    point_00 = [pointp[0],pointp[1]]
-    point_10 = [pointp[2],pointp[1]]
-    point_01 = [pointp[0],pointp[3]]
-    point_11 = [pointp[2],pointp[3]]
+    # Properties at the corners BL, BR, TL, TR of the rectangle pointp
+    x_pts = [pointp[0], pointp[2], pointp[0], pointp[2]]
+    z_pts = [pointp[1], pointp[1], pointp[3], pointp[3]]
+    return np.ndarray.tolist(get_coolprop_batch(x_pts, z_pts, response, trans, fluid))
 
-    points = [point_00, point_10, point_01, point_11]
-    dataNIST = []
-    dataCoolProp =[]
+####------------------Single flash evaluation with AbstractState------####
+# One CoolProp state per fluid (and per thread and process), updated once per
+# point; all the properties are then read from the same flash. Each thread
+# has its own, so tables can be built side by side in threads.
+abstract_states = threading.local()
 
-    ####--------------------In Temperature-Pressure space -----------####
+def get_abstract_state(fluid='Oxygen'):
+    states = abstract_states.__dict__
+    if fluid not in states:
+        states[fluid] = AbstractState('HEOS', fluid)
+    return states[fluid]
+
+def get_state_props(state, x, z, response):
     if response == "T-P":
-        for point in points:
-            x_mid = point[0]
-            z_mid = point[1]
+        state.update(CP.PT_INPUTS, z, x)
+        return [state.rhomass(), state.umass()/1000.0, state.hmass()/1000.0, state.smass()/1000.0, state.cvmass()/1000.0, state.cpmass()/1000.0, state.speed_sound(), state.viscosity(), state.conductivity()]
+    elif response == "rho-e":
+        try:
+            state.update(CP.DmassUmass_INPUTS, x, z)
+            phase = state.phase()
+        except ValueError:
+            phase = None
+        if phase == CP.iphase_twophase or phase == None: #bound to critical properties
+            state.update(CP.DmassUmass_INPUTS, 460.5914052903932, 17667.19156915298)
+        return [state.T(), state.p(), state.hmass()/1000.0, state.smass()/1000.0, state.cvmass()/1000.0, state.cpmass()/1000.0, state.speed_sound(), state.viscosity(), state.conductivity()]
+    elif response == "h-P" or response == "s-P":
+        if response == "h-P":
+            state.update(CP.HmassP_INPUTS, x, z)
+            props = [state.rhomass(), state.umass()/1000.0, state.T(), state.smass()/1000.0]
+        else:
+            state.update(CP.PSmass_INPUTS, z, x)
+            props = [state.rhomass(), state.umass()/1000.0, state.T(), state.hmass()/1000.0]
+        if state.phase() == CP.iphase_twophase: #bound to critical properties
+            state.update(CP.DmassUmass_INPUTS, 460.5914052903932, 17667.19156915298)
+        return props + [state.cvmass()/1000.0, state.cpmass()/1000.0, state.speed_sound(), state.viscosity(), state.conductivity()]
+    raise ValueError('unknown table index variables ' + str(response))
 
-            ######------------Re-transforming back to T-P--------##
-            x_mid, z_mid = np.ndarray.tolist(trans.inverse([x_mid, z_mid])[0])    
-                    
-            data_density = PropsSI('DMASS', 'P', z_mid,'T', x_mid, fluid)
-            #data_volume = 0
-            data_internal_energy = PropsSI('UMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-            data_enthalpy= PropsSI('HMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-            data_entropy= PropsSI('SMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-            data_cv = PropsSI('CVMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-            data_cp = PropsSI('CPMASS', 'P', z_mid,'T', x_mid, fluid)/1000.0
-            data_a = PropsSI('A', 'P', z_mid,'T', x_mid, fluid)
-            #data_joule = 0
-            data_mu= PropsSI('VISCOSITY', 'P', z_mid,'T', x_mid, fluid)
-            data_k = PropsSI('CONDUCTIVITY', 'P', z_mid,'T', x_mid, fluid)
-            data_phase = PropsSI('PHASE', 'P', z_mid,'T', x_mid, fluid)
-            #data = [data_density, data_volume, data_internal_energy, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_joule, data_mu, data_k, data_phase]
-            data = [data_density, data_internal_energy, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_mu, data_k]
-            dataCoolProp.append(data)
-            #print dataCoolProp
-
-            #---------------------NIST Database---------------------######
-            # data = NIST.readNIST(isoType = "isotherm", fluid = 'O2', T=x_mid, P=z_mid/1.0E6, tmin=x_mid, tmax=x_mid, pmin = z_mid/1.0E6, pmax = z_mid/1.0E6, N=1)
-            # data= np.ndarray.tolist(data)
-            # data= [item for sublist in data for item in sublist]
-            # del data[:2]
-            # dataNIST.append(data)
-            # print dataNIST
+def get_coolprop_batch(x_pts, z_pts, response, trans, fluid='Oxygen'):
+    # Properties at a batch of points of the transformed domain, one row of
+    # the 9 properties of get_coolprop_TPS per point
+    data = np.empty((len(x_pts), 9))
+    if len(x_pts) == 0:
+        return data
+    points = trans.inverse(np.column_stack((x_pts, z_pts)))
+    state = get_abstract_state(fluid)
+    for i in range(len(points)):
+        data[i] = get_state_props(state, points[i][0], points[i][1], response)
+    return data
 
-    elif response == "rho-e":
-        ####-----------------In Density-Internal Energy space -----------####
-        for point in points:
-            x_mid = point[0]
-            z_mid = point[1]
+class VertexCache():
+    #_______________________________________________________
+    # Properties at the points of the transformed domain, so that every point
+    # is evaluated only once during a build. Points are keyed by their integer
+    # coordinates (i, j) on a lattice of the given spacing (the minimum cell
+    # size for the corners), packed into one int64; points off the lattice are
+    # evaluated but not kept. The keys are one sorted array and the properties
+    # the rows of one (n, 9) array, about 80 bytes per point. New points wait
+    # in a small dictionary and are merged into the arrays in batches.
+    merge_size = 65536
 
-            [x_mid, z_mid] = np.ndarray.tolist(trans.inverse([x_mid, z_mid])[0])
-            data_phase = PhaseSI('UMASS', z_mid,'DMASS', x_mid, fluid)
-            data_phase = unicodedata.normalize('NFKD', data_phase).encode('ascii','ignore')
-            if data_phase == 'twophase': #bound to critical properties
-                x_mid = 460.5914052903932 
-                z_mid = 17667.19156915298
-            if data_phase == '':
-                x_mid = 460.5914052903932 
-                z_mid = 17667.19156915298
-            # if data_phase != 'supercritical':
-            #     x_mid = 460.5914052903932 
-            #     z_mid = 17667.19156915298
-
-            data_temp = PropsSI('T', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-            data_volume = 0
-            data_pressure = PropsSI('P', 'UMASS', z_mid,'DMASS', x_mid, fluid) #Pa
-            data_enthalpy= PropsSI('HMASS', 'UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0 #KJ/kg
-            data_entropy= PropsSI('SMASS','UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0 #KJ/kg.k
-            data_cv = PropsSI('CVMASS','UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0 #KJ/kg
-            data_cp = PropsSI('CPMASS', 'UMASS', z_mid,'DMASS', x_mid, fluid)/1000.0
-            data_a = PropsSI('A', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-            #data_joule = 0
-            data_mu= PropsSI('VISCOSITY', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-            data_k = PropsSI('CONDUCTIVITY', 'UMASS', z_mid,'DMASS', x_mid, fluid)
-            #data = [data_density, data_volume, data_internal_energy, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_joule, data_mu, data_k, data_phase]
-
-
-            data = [data_temp, data_pressure, data_enthalpy, data_entropy, data_cv, data_cp, data_a, data_mu, data_k]
-
-            dataCoolProp.append(data)
-
-    return dataCoolProp
+    def __init__(self, response, trans, spacing=1, fluid='Oxygen'):
+        self.response = response
+        self.trans = trans
+        self.spacing = float(spacing)
+        self.fluid = fluid
+        self.keys = np.empty(0, dtype=np.int64)
+        self.values = np.empty((0, 9))
+        self.pending = {}
+        self.evaluations = 0
+
+    # Pickled with the new points merged into the arrays, for checkpoints
+    # and worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['keys'], state['values'] = self.merged()
+        state['pending'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+
+    # Lattice keys of the points, i and j shifted by 2**30 so both fit in 31
+    # bits, and whether each point is on the lattice at all
+    def lattice_keys(self, x_pts, z_pts):
+        i = np.asarray(x_pts, dtype=float)/self.spacing
+        j = np.asarray(z_pts, dtype=float)/self.spacing
+        i_int = np.round(i)
+        j_int = np.round(j)
+        on = (np.abs(i - i_int) <= 1.0E-9) & (np.abs(j - j_int) <= 1.0E-9)
+        keys = ((i_int.astype(np.int64) + 2**30) << 31) | (j_int.astype(np.int64) + 2**30)
+        return keys, on
+
+    def points(self, keys):
+        x_pts = ((keys >> 31) - 2**30)*self.spacing
+        z_pts = ((keys & (2**31 - 1)) - 2**30)*self.spacing
+        return x_pts, z_pts
+
+    # Rows of the keys in the arrays, -1 for the keys that are not there
+    def rows(self, keys):
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[rows] == keys, rows, -1)
+
+    # The arrays with the pending points merged in; where a key is in both,
+    # the first of the arrays wins
+    def merged(self, keys=None, values=None):
+        if keys is None:
+            if len(self.pending) == 0:
+                return self.keys, self.values
+            keys = np.array(self.pending.keys(), dtype=np.int64)
+            values = np.array(self.pending.values(), dtype=float).reshape(-1, 9)
+        keys, first = np.unique(np.concatenate((self.keys, keys)), return_index=True)
+        return keys, np.concatenate((self.values, values))[first]
+
+    def flush(self):
+        self.keys, self.values = self.merged()
+        self.pending = {}
+
+    # Stores already known properties, one row per point
+    def store(self, x_pts, z_pts, data):
+        keys, on = self.lattice_keys(x_pts, z_pts)
+        rows = self.rows(keys)
+        for key, row, found, values in zip(np.ndarray.tolist(keys), np.ndarray.tolist(rows), on, data):
+            if not found:
+                continue
+            if row >= 0:
+                self.values[row] = values
+            else:
+                self.pending[key] = np.asarray(values, dtype=float)
+        if len(self.pending) >= self.merge_size:
+            self.flush()
+
+    # Adds the points of another cache that are not in this one (the cache of
+    # a tile built in a worker process)
+    def update(self, other):
+        self.flush()
+        keys, values = other.merged()
+        self.keys, self.values = self.merged(keys, values)
+
+    # A cache with only the points inside rect = [x0, z0, x1, z1]
+    def within(self, rect):
+        self.flush()
+        x_pts, z_pts = self.points(self.keys)
+        inside = (x_pts >= rect[0]) & (x_pts <= rect[2]) & (z_pts >= rect[1]) & (z_pts <= rect[3])
+        cache = VertexCache(self.response, self.trans, self.spacing, self.fluid)
+        cache.keys = self.keys[inside]
+        cache.values = self.values[inside]
+        return cache
+
+    # The points that are in the cache already and their properties, nothing
+    # is evaluated
+    def find(self, x_pts, z_pts):
+        keys, on = self.lattice_keys(x_pts, z_pts)
+        rows = self.rows(keys)
+        found = []
+        data = []
+        for i, (key, row) in enumerate(zip(np.ndarray.tolist(keys), np.ndarray.tolist(rows))):
+            if not on[i]:
+                continue
+            if row >= 0:
+                found.append(i)
+                data.append(np.ndarray.tolist(self.values[row]))
+            elif key in self.pending:
+                found.append(i)
+                data.append(np.ndarray.tolist(self.pending[key]))
+        return found, data
+
+    # Same as get_coolprop_batch(), only the points that are not in the
+    # cache yet are evaluated (in a single batch)
+    def get(self, x_pts, z_pts):
+        keys, on = self.lattice_keys(x_pts, z_pts)
+        rows = self.rows(keys)
+        data = np.empty((len(keys), 9))
+        known = on & (rows >= 0)
+        data[known] = self.values[rows[known]]
+
+        keys = np.ndarray.tolist(keys)
+        new = []
+        first = {}
+        repeated = []
+        for i in np.nonzero(~known)[0]:
+            if on[i]:
+                if keys[i] in self.pending:
+                    data[i] = self.pending[keys[i]]
+                    continue
+                if keys[i] in first:
+                    repeated.append(i)
+                    continue
+                first[keys[i]] = i
+            new.append(i)
+        data_new = get_coolprop_batch([x_pts[i] for i in new], [z_pts[i] for i in new], self.response, self.trans, self.fluid)
+        self.evaluations += len(new)
+
+        for i, row in zip(new, data_new):
+            data[i] = row
+            if on[i]:
+                self.pending[keys[i]] = row
+        for i in repeated:
+            data[i] = data[first[keys[i]]]
+        if len(self.pending) >= self.merge_size:
+            self.flush()
+        return data
 
 def check_out_of_bound(x_c, z_c, response, trans, fluid="Oxygen"):
 
@@ -6,6 +6,12 @@ import numpy as np
 import NIST_reader as NIST
 import quad_utilities as utility
 import math
+import multiprocessing
+import os
+import signal
+import time
+import heapq
+import traceback
 from pdb import set_trace as keyboard
 from skimage.transform import ProjectiveTransform
 
@@ -13,7 +19,8 @@ class Node():
     ROOT = 0
     BRANCH = 1
     LEAF = 2
-    minsize = 1   # Set by QuadTree
+    minsize = 1
+    sample_level = 2  # spans_feature samples every 1/2**sample_level of the cell (a 3x3 interior grid)
     #_______________________________________________________.
     # In the case of a root node "parent" will be None. The
     # "rect" lists the minx,minz,maxx,maxz of the rectangle
@@ -33,151 +40,974 @@ class Node():
         if self.parent == None:
             self.type = Node.ROOT #if there is no parent then this is the root
             self.index = 0
-        elif (x1 - x0) <= Node.minsize:
+        elif (x1 - x0) <= self.minsize:
             self.type = Node.LEAF # if there is a parent, see if this is the final node i.e., leaf
         else:
             self.type = Node.BRANCH #if it is not parent and not a leaf, then it is a branch
+    #_______________________________________________________
+    # Sub-classes must override these two methods.
+    def getinstance(self,rect):
+        return Node(self,rect)            
+
+#===========================================================
+class LinearQuadTree():
+    #_______________________________________________________
+    # Array ("structure of arrays") storage of the tree, used instead of a
+    # Node object per cell. Node i of the tree is described by
+    #   child[i]   offset of its first child, the children are stored one after
+    #              the other in the order BL, TL, TR, BR (-1 for a leaf)
+    #   nchild[i]  the number of its children, 4, or 2 for a cell split in one
+    #              direction only (left, right or bottom, top, see split())
+    #   parent[i]  offset of its parent (-1 for the root)
+    #   depth[i]   its level in the tree
+    #   index[i]   the 4*parent_index + n + 1 numbering of the cells
+    #   rect[i]    minx, minz, maxx, maxz
+    #   prop[i]    the 9 properties at the corners BL, BR, TL, TR (rect_prop)
+    # A cell that is not a square gets the depth and index of the square at its
+    # BL corner whose side is the short side of the cell (see cell_index()).
+    # The root normally is the whole domain (depth and index 0), but it can
+    # be any cell of it ("domain"), e.g. a tile built by a worker process.
+    # Each tree has its own settings: the minimum cell size, the property
+    # cache of the lattice points (utility.VertexCache), whether cells
+    # may be split in one direction only (see split_modes()) and the accuracy
+    # it is refined to (None when not known, see QuadTree.prune()).
+    batch = 4096 # cells split together by subdivide()
+    checkpoint_interval = 600 # seconds between two checkpoints of subdivide()
+    final_error = 0.5 # see split_modes()
+    # the bytes of the table written by QuadTree (with pickle.HIGHEST_PROTOCOL)
+    # for each leaf and for each entry of its map of Morton codes to leaves
+    # (see code_ranges()), measured on the written tables
+    leaf_bytes = 490
+    range_bytes = 12
+
+    def __init__(self, rect, rect_prop, depth=0, index=0, capacity=1024, domain=None, minsize=1, cache=None, anisotropic=False):
+        self.size = 0
+        self.capacity = 0
+        self.minsize = minsize
+        self.cache = cache
+        self.anisotropic = anisotropic
+        self.accuracy = None
+        self.domain = domain
+        if domain == None:
+            self.domain = tuple(rect)
+        self.reserve(capacity)
+        self.add([rect], [rect_prop], [-1], [depth], [index])
+
+    # Makes room for at least "capacity" nodes
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2*self.capacity)
+        child = np.full(capacity, -1, dtype=np.int32)
+        nchild = np.zeros(capacity, dtype=np.uint8)
+        parent = np.full(capacity, -1, dtype=np.int32)
+        depth = np.zeros(capacity, dtype=np.uint8)
+        index = np.zeros(capacity, dtype=np.int64)
+        rect = np.zeros((capacity, 4))
+        prop = np.zeros((capacity, 4, 9))
+        if self.size > 0:
+            child[:self.size] = self.child[:self.size]
+            nchild[:self.size] = self.nchild[:self.size]
+            parent[:self.size] = self.parent[:self.size]
+            depth[:self.size] = self.depth[:self.size]
+            index[:self.size] = self.index[:self.size]
+            rect[:self.size] = self.rect[:self.size]
+            prop[:self.size] = self.prop[:self.size]
+        self.child, self.nchild, self.parent, self.depth, self.index, self.rect, self.prop = child, nchild, parent, depth, index, rect, prop
+        self.capacity = capacity
+
+    # Appends new (leaf) nodes, returns the offset of the first one
+    def add(self, rects, props, parents, depths, indices):
+        first = self.size
+        last = first + len(rects)
+        self.reserve(last)
+        self.rect[first:last] = rects
+        self.prop[first:last] = props
+        self.parent[first:last] = parents
+        self.depth[first:last] = depths
+        self.index[first:last] = indices
+        self.child[first:last] = -1
+        self.nchild[first:last] = 0
+        self.size = last
+        return first
+
+    # Drops the unused capacity, e.g. before the tree is pickled
+    def trim(self):
+        self.child = self.child[:self.size].copy()
+        self.nchild = self.nchild[:self.size].copy()
+        self.parent = self.parent[:self.size].copy()
+        self.depth = self.depth[:self.size].copy()
+        self.index = self.index[:self.size].copy()
+        self.rect = self.rect[:self.size].copy()
+        self.prop = self.prop[:self.size].copy()
+        self.capacity = self.size
+
+    # Only the used part of the arrays is pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['child', 'nchild', 'parent', 'depth', 'index', 'rect', 'prop']:
+            state[name] = state[name][:self.size]
+        state['capacity'] = self.size
+        return state
+
+    # Drops the nodes that are not in the tree any more (the children of
+    # merged cells), the nodes are renumbered breadth first
+    def compact(self):
+        order = [0]
+        for i in order:
+            order.extend(self.children(i))
+        if len(order) == self.size:
+            return
+        order = np.asarray(order)
+        offset = np.full(self.size, -1, dtype=np.int32)
+        offset[order] = np.arange(len(order))
+        child = self.child[order]
+        self.child = np.where(child == -1, -1, offset[child]).astype(np.int32)
+        self.nchild = self.nchild[order]
+        parent = self.parent[order]
+        self.parent = np.where(parent == -1, -1, offset[parent]).astype(np.int32)
+        self.depth = self.depth[order]
+        self.index = self.index[order]
+        self.rect = self.rect[order]
+        self.prop = self.prop[order]
+        self.size = self.capacity = len(order)
+
+    # The leaf that contains the point (x, z), -1 if it is outside the root
+    def locate(self, x, z):
+        x0,z0,x1,z1 = self.rect[0]
+        if not (x0 <= x <= x1 and z0 <= z <= z1):
+            return -1
+        i = 0
+        while self.child[i] != -1:
+            x0,z0,x1,z1 = self.rect[i]
+            right = x >= (x0 + x1)/2
+            top = z >= (z0 + z1)/2
+            c = self.child[i]
+            if self.nchild[i] == 2:
+                if self.rect[c][2] < x1: #left, right
+                    i = c + (1 if right else 0)
+                else: #bottom, top
+                    i = c + (1 if top else 0)
+            elif right:
+                i = c + (2 if top else 3) #TR or BR
+            else:
+                i = c + (1 if top else 0) #TL or BL
+        return i
+
+    # The depth and index of the square cells of side "side" with BL corner
+    # (x0, z0), as if they were cells of a quadtree of the whole domain
+    def cell_index(self, x0, z0, side):
+        dx0,dz0,dx1,dz1 = self.domain
+        x0, z0, side = np.broadcast_arrays(np.asarray(x0, dtype=float), z0, side)
+        depth = np.round(np.log2((dx1 - dx0)/side)).astype(int)
+        ix = np.round((x0 - dx0)/side).astype(np.int64)
+        iz = np.round((z0 - dz0)/side).astype(np.int64)
+        return depth, square_index(ix, iz, depth)
+
+    #______________________________________________________
+    # 2:1 balancing: splits the leaves until the edge of every leaf is at most
+    # twice as long as the edges of the leaves across it. Only the leaves that
+    # found a coarse neighbour and the new leaves can still be unbalanced, so
+    # only they are checked in the next round. With self.anisotropic a leaf
+    # is split only in the direction of the edge that is too long.
+    # "leaves" are the leaves to check first, all of them by default; once
+    # a balanced tree is split only the new leaves need to be checked.
+    def balance(self, leaves=None):
+        if leaves is None:
+            leaves = [i for i in range(self.size) if self.is_leaf(i)]
+        offset = self.minsize/2.0 #less than the size of any leaf
+        splits = 0
+        while leaves:
+            modes = {}
+            fine = []
+            for i in leaves:
+                x0,z0,x1,z1 = self.rect[i]
+                xm = (x0 + x1)/2
+                zm = (z0 + z1)/2
+                for x, z, mode in [(xm, z0 - offset, 1), (xm, z1 + offset, 1), (x0 - offset, zm, 2), (x1 + offset, zm, 2)]:
+                    j = self.locate(x, z)
+                    if j == -1:
+                        continue
+                    if (mode == 1 and self.rect[j][2] - self.rect[j][0] > 2*(x1 - x0)) or (mode == 2 and self.rect[j][3] - self.rect[j][1] > 2*(z1 - z0)):
+                        if not self.anisotropic or modes.get(j, mode) != mode:
+                            mode = 0
+                        modes[j] = mode
+                        fine.append(i)
+            leaves = []
+            if modes:
+                coarse = sorted(modes)
+                leaves = sorted(set(fine)) + self.split(coarse, [modes[j] for j in coarse])
+                splits += len(coarse)
+        return splits
+
+    #______________________________________________________
+    # Conforming interpolation: a corner of a leaf that lies on the edge of a
+    # coarser leaf (a hanging node) takes the value the coarser leaf
+    # interpolates there, so the bilinear reconstruction is continuous from
+    # one leaf to the next. Needs a 2:1 balanced tree (see balance()), the
+    # hanging nodes then are the midpoints of the edges. The ends of an edge
+    # may be hanging nodes themselves, they are on a coarser dyadic grid than
+    # its midpoint (see dyadic_level) so the edges are taken coarsest first.
+    # Returns the number of hanging nodes.
+    def constrain_hanging_nodes(self):
+        leaves = [i for i in range(self.size) if self.is_leaf(i)]
+        values = {}
+        for i in leaves:
+            x0,z0,x1,z1 = self.rect[i]
+            for point, prop in zip([(x0, z0), (x1, z0), (x0, z1), (x1, z1)], self.prop[i]):
+                values[point] = prop
+        # edges as midpoint and ends
+        edges = []
+        for i in leaves:
+            x0,z0,x1,z1 = self.rect[i]
+            xm = (x0 + x1)/2
+            zm = (z0 + z1)/2
+            edges.extend([((xm, z0), (x0, z0), (x1, z0)), ((xm, z1), (x0, z1), (x1, z1))])
+            edges.extend([((x0, zm), (x0, z0), (x0, z1)), ((x1, zm), (x1, z0), (x1, z1))])
+        hanging = 0
+        for mid, a, b in sorted(edges, key=lambda edge: dyadic_level(edge[0][0]) + dyadic_level(edge[0][1])):
+            if mid in values:
+                values[mid] = (values[a] + values[b])/2
+                hanging += 1
+        for i in leaves:
+            x0,z0,x1,z1 = self.rect[i]
+            self.prop[i] = [values[(x0, z0)], values[(x1, z0)], values[(x0, z1)], values[(x1, z1)]]
+        return hanging
+
+    def is_leaf(self, i):
+        return self.child[i] == -1
+
+    def children(self, i):
+        if self.child[i] == -1:
+            return []
+        return range(self.child[i], self.child[i] + self.nchild[i])
+
+    # The LEAF nodes below node i, depth first in the order of the children.
+    # This is done with a stack rather than recursion, in time linear in the
+    # number of nodes below i.
+    def leaves_below(self, i=0):
+        child = np.ndarray.tolist(self.child[:self.size])
+        nchild = np.ndarray.tolist(self.nchild[:self.size])
+        leaves = []
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            if child[i] == -1:
+                leaves.append(i)
+            else:
+                stack.extend(range(child[i] + nchild[i] - 1, child[i] - 1, -1))
+        return np.array(leaves, dtype=np.int64)
+
+    # The number of ranges of consecutive Morton codes of the finest level
+    # that each of the leaves covers, i.e. its entries in the map of
+    # QuadTree.export(): 1 for a square, for a cell split in one direction
+    # only one for each run of consecutive codes of the squares it is made of
+    def code_ranges(self, leaves):
+        dx0,dz0,dx1,dz1 = self.domain
+        ranges = []
+        for i in leaves:
+            x0,z0,x1,z1 = self.rect[i]
+            side = min(x1 - x0, z1 - z0)
+            nx = int(round((x1 - x0)/side))
+            nz = int(round((z1 - z0)/side))
+            if nx*nz == 1:
+                ranges.append(1)
+                continue
+            ix = int(round((x0 - dx0)/side)) + np.tile(np.arange(nx), nz)
+            iz = int(round((z0 - dz0)/side)) + np.repeat(np.arange(nz), nx)
+            code = np.sort(morton_code(ix, iz))
+            ranges.append(1 + int(np.sum(np.diff(code) != 1)))
+        return ranges
+
+    # The cells that can still be split, i.e. that are larger than
+    # self.minsize in some direction (in both of them unless self.anisotropic)
+    def splittable(self, cells):
+        if self.anisotropic:
+            return [i for i in cells if max(self.rect[i][2] - self.rect[i][0], self.rect[i][3] - self.rect[i][1]) > self.minsize]
+        return [i for i in cells if self.rect[i][2] - self.rect[i][0] > self.minsize]
+
+    #______________________________________________________
+    # Subdivides the cells in "frontier" one level at a time (breadth first).
+    # Division occurs ONLY if the rectangle spans a "feature of interest" or the
+    # error is large enough, which is tested by node.spans_feature() ("node"
+    # being e.g. the CNode of the root).
+    # The whole refinement frontier of a level is split together, so the corner
+    # properties of all the new children and the error samples of all of them
+    # are each evaluated as one batch instead of one cell at a time.
+    # With "levels" given, stops after that many levels and returns the nodes
+    # that still have to be refined.
+    # With "checkpoint" given, the tree, the cells still to be refined and
+    # self.cache are saved to that file every checkpoint_interval seconds, when
+    # the build fails or is interrupted, and once it is done (see
+    # save_checkpoint); the frontier is split in batches so that this can
+    # happen within a level.
+    # With "stop" (a multiprocessing.Event) set, the refinement stops before
+    # the next batch as if it were interrupted (see subdivide_parallel).
+    def subdivide(self, frontier, node, accuracy, response, trans, levels=None, checkpoint=None, stop=None):
+        frontier = self.splittable(frontier)
+        level = 0
+        saved = time.time()
+        while frontier and (levels == None or level < levels):
+            print "Subdividing further in level: ", self.depth[frontier[0]], " no. of cells: ", len(frontier)
+            next_frontier = []
+            for start in range(0, len(frontier), self.batch):
+                try:
+                    if stop != None and stop.is_set():
+                        raise SystemExit("Terminated")
+                    cells = frontier[start:start + self.batch]
+                    modes, final = self.split_modes(cells, node, accuracy, response, trans)
+                    children = self.split(cells, modes)
+                    # leaves can not be divided any further and final ones need not be, so
+                    # there is no need to sample their error
+                    final = set([i for i, done in zip(cells, final) if done])
+                    children = self.splittable([j for j in children if self.parent[j] not in final])
+                    spans = self.spans_features(children, node, accuracy, response, trans) #for each child, check if it spans a feature
+                except BaseException:
+                    if checkpoint != None:
+                        # the batch may have been split already, its children are then
+                        # dropped and it is split again on resume
+                        self.rollback(frontier[start:start + self.batch])
+                        save_checkpoint(checkpoint, self, frontier[start:] + next_frontier, self.cache)
+                        print "Build stopped, saved a checkpoint in ", checkpoint
+                    raise
+                next_frontier.extend([child for child, span in zip(children, spans) if span == True])
+                if checkpoint != None and time.time() - saved > self.checkpoint_interval:
+                    save_checkpoint(checkpoint, self, frontier[start + self.batch:] + next_frontier, self.cache)
+                    saved = time.time()
+            frontier = next_frontier
+            level += 1
+        if checkpoint != None:
+            save_checkpoint(checkpoint, self, frontier, self.cache)
+        return frontier
+
+    #______________________________________________________
+    # Removes the children of "nodes" if they were the last ones added
+    def rollback(self, nodes):
+        nodes = [i for i in nodes if self.child[i] != -1]
+        if nodes:
+            first = min([self.child[i] for i in nodes])
+            if first + sum([self.nchild[i] for i in nodes]) == self.size:
+                self.child[nodes] = -1
+                self.nchild[nodes] = 0
+                self.size = first
+
+    #______________________________________________________
+    # Refines the first "tile_level" levels here, then refines the subtree of
+    # every remaining tile (up to 4**tile_level of them) in a pool of worker
+    # processes. The subtrees are stitched back under their tiles; as every tile
+    # keeps its index the 4*parent_index + n + 1 numbering is unchanged and the
+    # tree is the same as the one built by subdivide().
+    # With "checkpoint" given, the tree is saved once the tiles are set up and
+    # every worker saves its own tile in "checkpoint.<tile index>"; with
+    # "resume" the tiles already saved are not refined again.
+    # With "tiled" the cells of "frontier" already are the tiles.
+    # The workers ignore SIGTERM and SIGINT: when this process is interrupted
+    # it asks them to stop, each one saves its tile and returns, and only then
+    # the interruption is raised here. The tiles are waited for in short steps
+    # so that the signal handlers of this process keep running.
+    def subdivide_parallel(self, frontier, node, accuracy, response, trans, tile_level, processes, checkpoint=None, resume=False, tiled=False):
+        if tiled:
+            tiles = frontier
+        else:
+            tiles = self.subdivide(frontier, node, accuracy, response, trans, tile_level)
+            if checkpoint != None:
+                save_checkpoint(checkpoint, self, tiles, self.cache, True)
+        if not tiles:
+            return
+        print "Refining ", len(tiles), " tiles on ", processes, " processes"
+        jobs = []
+        for tile in tiles:
+            tile_checkpoint = None
+            if checkpoint != None:
+                tile_checkpoint = checkpoint + "." + str(self.index[tile])
+            jobs.append((self.rect[tile], self.prop[tile], self.depth[tile], self.index[tile], self.domain, node, accuracy, response, trans, self.minsize, self.anisotropic, self.cache.within(self.rect[tile]), tile_checkpoint, resume))
+        stop = multiprocessing.Event()
+        pool = multiprocessing.Pool(processes, _init_worker, (stop,))
+        try:
+            result = pool.map_async(_subdivide_tile, jobs, 1)
+            try:
+                while not result.ready():
+                    result.wait(1.0)
+            except BaseException:
+                stop.set()
+                while not result.ready():
+                    result.wait(1.0)
+                raise
+            subtrees = result.get()
+        finally:
+            pool.close()
+            pool.join()
+        errors = [cache for subtree, cache in subtrees if subtree == None]
+        if errors:
+            # the tiles that failed are saved in their checkpoints
+            raise RuntimeError('refinement of ' + str(len(errors)) + ' tiles failed:\n' + errors[0])
+        for tile, (subtree, cache) in zip(tiles, subtrees):
+            self.cache.update(cache)
+            self.cache.evaluations += cache.evaluations
+            self.attach(tile, subtree)
+        if checkpoint != None:
+            save_checkpoint(checkpoint, self, [], self.cache)
+            for job in jobs:
+                os.remove(job[12])
+
     #______________________________________________________
-    # Recursively subdivides a rectangle. Division occurs 
-    # ONLY if the rectangle spans a "feature of interest" or the error is large enough.
-    def subdivide(self, parent_index, accuracy, response, trans):
-        if self.type == Node.LEAF: #if it is a leaf you can't go any further..so return nothing
+    # Appends the nodes of "subtree" below the leaf "tile", whose root is a
+    # copy of the tile.
+    def attach(self, tile, subtree):
+        if subtree.size == 1:
             return
-        x0,z0,x1,z1 = self.rect #assign the outline coordinates to the rectangle
-        dx = (x1 - x0)/2
-        dz = (z1 - z0)/2
-
-        rects = [] 
-        rects_prop = []
-        rects.append( (x0, z0, x0 + dx, z0 + dz) ) #just appending the list of new child rect coordinates
-        rects.append( (x0, z0 + dz, x0 + dx, z1) )
-        rects.append( (x0 + dx, z0 + dz, x1, z1) )
-        rects.append( (x0 + dx, z0, x1, z0 + dz) )
-        
-        for n in range(len(rects)):
-            #check if they're out of bounds
-            # check = utility.check_out_of_bound_points(rects[n], response, trans)
-            # if check:
-            #     rects_prop.append(self.rect_prop)
-            # else:
-            rects_prop.append( utility.get_coolprop_TP(rects[n], response, trans))
-            self.children[n] = self.getinstance(rects[n], rects_prop[n], parent_index, n, accuracy, response, trans) #assigning the class function to that child        
-
-        # for n in range(len(rects)):
-        #     #rects_prop.append( utility.get_dataNIST_I(rects[n]) )
-        #     rects_prop.append( utility.get_coolprop_TP(rects[n]))
-        #     span = self.spans_feature(rects[n], rects_prop[n], self.depth, accuracy) #for each child, check if it spans a feature
-        #     self.children[n] = self.getinstance(rects[n], rects_prop[n], parent_index, n, accuracy) #assigning the class function to that child
-        #     if span == True:
-        #         #if not(self.type == Node.ROOT):
-        #             keyboard()
-        #             print "Subdividing further in level: ",self.depth
-        #             print "Current point's index:    ", self.children[n].index
-        #             self.children[n].subdivide(self.children[n].index, accuracy) # << recursion
-                #else:
-                    #Node.subdivide()
-        for no, child in enumerate(self.children):
-            span = self.spans_feature(child.rect, child.rect_prop, child.depth, accuracy, response, trans) #for each child, check if it spans a feature
-            if span == True:
-                    print "Subdividing further in level: ",self.depth
-                    print "Current point's index:    ", self.children[n].index
-                    child.subdivide(child.index, accuracy, response, trans) # << recursion
+        offset = self.size - 1
+        last = self.size + subtree.size - 1
+        self.reserve(last)
+        self.rect[self.size:last] = subtree.rect[1:subtree.size]
+        self.prop[self.size:last] = subtree.prop[1:subtree.size]
+        self.depth[self.size:last] = subtree.depth[1:subtree.size]
+        self.index[self.size:last] = subtree.index[1:subtree.size]
+        child = subtree.child[1:subtree.size]
+        self.child[self.size:last] = np.where(child == -1, -1, child + offset)
+        self.nchild[self.size:last] = subtree.nchild[1:subtree.size]
+        parent = subtree.parent[1:subtree.size]
+        self.parent[self.size:last] = np.where(parent == 0, tile, parent + offset)
+        self.child[tile] = subtree.child[0] + offset
+        self.nchild[tile] = subtree.nchild[0]
+        self.size = last
 
+    #______________________________________________________
+    # Creates the children of every node in "nodes", split as given by
+    # "modes" (see split_modes(), by default in four). The corner
+    # properties of all the children are evaluated in a single batch.
+    def split(self, nodes, modes=None):
+        if len(nodes) == 0:
+            return []
+        nodes = np.asarray(nodes)
+        if modes is None:
+            modes = np.zeros(len(nodes), dtype=int)
+        modes = np.asarray(modes)
+        x0,z0,x1,z1 = self.rect[nodes].T #assign the outline coordinates to the rectangle
+        xm = (x0 + x1)/2
+        zm = (z0 + z1)/2
+        quadrants = np.empty((len(nodes), 4, 4)) #the new child rect coordinates
+        quadrants[:, 0] = np.column_stack((x0, z0, xm, zm))
+        quadrants[:, 1] = np.column_stack((x0, zm, xm, z1))
+        quadrants[:, 2] = np.column_stack((xm, zm, x1, z1))
+        quadrants[:, 3] = np.column_stack((xm, z0, x1, zm))
+        halves_x = np.empty((len(nodes), 2, 4)) #left, right
+        halves_x[:, 0] = np.column_stack((x0, z0, xm, z1))
+        halves_x[:, 1] = np.column_stack((xm, z0, x1, z1))
+        halves_z = np.empty((len(nodes), 2, 4)) #bottom, top
+        halves_z[:, 0] = np.column_stack((x0, z0, x1, zm))
+        halves_z[:, 1] = np.column_stack((x0, zm, x1, z1))
+        counts = np.where(modes == 0, 4, 2)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        rects = np.empty((np.sum(counts), 4))
+        for mode, children in [(0, quadrants), (1, halves_x), (2, halves_z)]:
+            selected = modes == mode
+            rows = starts[selected][:, None] + np.arange(children.shape[1])
+            rects[rows.ravel()] = children[selected].reshape(-1, 4)
 
+        # corners in the order BL, BR, TL, TR as in utility.get_coolprop_TP
+        x_pts = np.column_stack((rects[:, 0], rects[:, 2], rects[:, 0], rects[:, 2])).ravel()
+        z_pts = np.column_stack((rects[:, 1], rects[:, 1], rects[:, 3], rects[:, 3])).ravel()
+        props = self.cache.get(x_pts, z_pts).reshape(-1, 4, 9)
 
-    #_______________________________________________________
-    # Sub-classes must override these two methods.
-    def getinstance(self,rect):
-        return Node(self,rect)            
+        parents = np.repeat(nodes, counts)
+        depths, indices = self.cell_index(rects[:, 0], rects[:, 1], np.minimum(rects[:, 2] - rects[:, 0], rects[:, 3] - rects[:, 1]))
+        first = self.add(rects, props, parents, depths, indices)
+        self.child[nodes] = first + starts
+        self.nchild[nodes] = counts
+        return range(first, self.size)
+
+    #______________________________________________________
+    # How the cells are split: 0 in four, 1 in a left and a right half, 2 in
+    # a bottom and a top half, and whether their children are final, i.e.
+    # meet the accuracy as they are and are neither sampled nor refined.
+    # Unless self.anisotropic they are split in four. Otherwise a cell is
+    # split in one direction only if both halves meet the accuracy with a
+    # margin (node.feature_error() < self.final_error) at its feature points
+    # and at the midpoints of the edges that lie on their sides; of the two
+    # directions, the one with the smaller error. The halves are checked on
+    # fewer points than their own samples, hence the margin. The midpoints
+    # are corners of the children in either case. A cell at the minimum size
+    # in one direction is split in the other one, its children are refined
+    # further.
+    def split_modes(self, cells, node, accuracy, response, trans):
+        if not self.anisotropic:
+            return [0]*len(cells), [False]*len(cells)
+        x_pts = []
+        z_pts = []
+        for i in cells:
+            x0,z0,x1,z1 = self.rect[i]
+            x_pts.extend([(x0 + x1)/2, (x0 + x1)/2, x0, x1])
+            z_pts.extend([z0, z1, (z0 + z1)/2, (z0 + z1)/2])
+        mids = np.ndarray.tolist(self.cache.get(x_pts, z_pts))
+        modes = []
+        final = []
+        for n, (i, dataNIST) in enumerate(zip(cells, self.samples(cells, node))):
+            x0,z0,x1,z1 = rect = tuple(self.rect[i])
+            if x1 - x0 <= self.minsize or z1 - z0 <= self.minsize:
+                modes.append(2 if x1 - x0 <= self.minsize else 1)
+                final.append(False)
+                continue
+            xm = (x0 + x1)/2
+            zm = (z0 + z1)/2
+            bl, br, tl, tr = np.ndarray.tolist(self.prop[i])
+            b, t, l, r = mids[4*n:4*n + 4]
+            points = node.feature_points(rect) + [(xm, z0), (xm, z1), (x0, zm), (x1, zm)]
+            data = dataNIST + [b, t, l, r]
+            def error(halves):
+                errors = []
+                for (hx0, hz0, hx1, hz1), rect_prop in halves:
+                    inside = [k for k, (x, z) in enumerate(points) if hx0 <= x <= hx1 and hz0 <= z <= hz1]
+                    errors.append(node.feature_error((hx0, hz0, hx1, hz1), rect_prop, accuracy, response, trans, [data[k] for k in inside], [points[k] for k in inside]))
+                return max(errors)
+            error_x = error([((x0, z0, xm, z1), [bl, b, tl, t]), ((xm, z0, x1, z1), [b, br, t, tr])])
+            error_z = error([((x0, z0, x1, zm), [bl, br, l, r]), ((x0, zm, x1, z1), [l, r, tl, tr])])
+            if min(error_x, error_z) < self.final_error:
+                modes.append(1 if error_x <= error_z else 2)
+                final.append(True)
+            else:
+                modes.append(0)
+                final.append(False)
+        return modes, final
+
+    #______________________________________________________
+    # Batched version of node.spans_feature(). The error samples of all the
+    # cells are evaluated together, then each cell is tested on its own.
+    def spans_features(self, cells, node, accuracy, response, trans):
+        spans = []
+        for i, dataNIST in zip(cells, self.samples(cells, node)):
+            spans.append(node.spans_feature(tuple(self.rect[i]), np.ndarray.tolist(self.prop[i]), self.depth[i], accuracy, response, trans, dataNIST))
+        return spans
+
+    # Same for node.feature_error()
+    def feature_errors(self, cells, node, accuracy, response, trans):
+        errors = []
+        for i, dataNIST in zip(cells, self.samples(cells, node)):
+            errors.append(node.feature_error(tuple(self.rect[i]), np.ndarray.tolist(self.prop[i]), accuracy, response, trans, dataNIST))
+        return errors
+
+    # The properties at the node.feature_points() of every cell, evaluated
+    # as one batch
+    def samples(self, cells, node):
+        x_pts = []
+        z_pts = []
+        counts = []
+        for i in cells:
+            points = node.feature_points(tuple(self.rect[i]))
+            x_pts.extend([point[0] for point in points])
+            z_pts.extend([point[1] for point in points])
+            counts.append(len(points))
+        data = np.ndarray.tolist(self.cache.get(x_pts, z_pts))
+        samples = []
+        start = 0
+        for count in counts:
+            samples.append(data[start:start + count])
+            start += count
+        return samples
+
+    #______________________________________________________
+    # Refines under a budget instead of down to the accuracy everywhere: the
+    # leaves among "cells" are kept in a max-heap ordered by the error
+    # node.feature_error() estimates and the worst one is always split next.
+    # Stops once the tree has max_leaves leaves, its table would take more
+    # than max_bytes (leaf_bytes for each leaf and range_bytes for each entry
+    # of its map, see code_ranges()) or every cell meets the accuracy, so the
+    # table is the most accurate one of that size. A split adds 3 leaves, or
+    # 1 for a cell split in one direction only (see split_modes()); a cell
+    # whose split does not fit any more is left as it is and the next one is
+    # tried. Cells at the minimum size or the maximum depth (see
+    # spans_feature) are not split.
+    # With "balanced" the tree is kept 2:1 balanced (see balance()): the
+    # splits of the neighbours that a split forces are counted with it, and
+    # they are all undone when they do not fit.
+    # With "checkpoint" given, the tree, the cells of the heap and the cache
+    # are saved as in subdivide(): every checkpoint_interval seconds, when the
+    # build fails or is interrupted (the split under way is undone first) and
+    # once it is done. Resumed with those cells, the heap is the same again;
+    # their errors are computed from their samples in the cache.
+    def subdivide_budget(self, cells, node, accuracy, response, trans, max_leaves=None, max_bytes=None, balanced=False, checkpoint=None):
+        if balanced:
+            self.balance() # e.g. a table read by load_table
+        all_leaves = [i for i in range(self.size) if self.is_leaf(i)]
+        leaves = len(all_leaves)
+        ranges = sum(self.code_ranges(all_leaves))
+        def fits(leaves, ranges):
+            if max_leaves != None and leaves > max_leaves:
+                return False
+            return max_bytes == None or leaves*self.leaf_bytes + ranges*self.range_bytes <= max_bytes
+        heap = []
+        def push(cells):
+            cells = [i for i in self.splittable(cells) if self.depth[i] < 13]
+            for i, error in zip(cells, self.feature_errors(cells, node, accuracy, response, trans)):
+                heapq.heappush(heap, (-error, i))
+        # undoes the splits of the nodes before "first" that made nodes from it on
+        def undo(first):
+            split = np.nonzero(self.child[:first] >= first)[0]
+            self.child[split] = -1
+            self.nchild[split] = 0
+            self.size = first
+        skipped = [] # the cells whose split did not fit
+        popped = None
+        def saved_cells():
+            # the leaves of the heap, those of an undone split are dropped
+            return [i for error, i in heap + skipped if i < self.size and self.is_leaf(i)]
+        print "Refining the worst cells first, up to ", max_leaves, " leaves and ", max_bytes, " bytes"
+        saved = time.time()
+        first = self.size
+        try:
+            push([i for i in cells if self.is_leaf(i)])
+            while heap and fits(leaves + 1, ranges + 1) and -heap[0][0] >= 1.0:
+                first = self.size
+                popped = heapq.heappop(heap)
+                error, i = popped
+                if not self.is_leaf(i): # split by balance()
+                    continue
+                modes, final = self.split_modes([i], node, accuracy, response, trans)
+                # a split never takes fewer ranges than before
+                if not fits(leaves + (3 if modes[0] == 0 else 1), ranges):
+                    skipped.append((error, i))
+                    continue
+                children = self.split([i], modes)
+                if balanced:
+                    self.balance(children)
+                # the leaves split in this step and the new ones
+                split = [j for j in set(np.ndarray.tolist(self.parent[first:self.size])) if j < first]
+                new = [j for j in range(first, self.size) if self.is_leaf(j)]
+                added = sum(self.code_ranges(new)) - sum(self.code_ranges(split))
+                if not fits(leaves + len(new) - len(split), ranges + added):
+                    undo(first)
+                    skipped.append((error, i))
+                    continue
+                push([j for j in new if not (final[0] and self.parent[j] == i)])
+                leaves += len(new) - len(split)
+                ranges += added
+                first = self.size
+                if checkpoint != None and time.time() - saved > self.checkpoint_interval:
+                    save_checkpoint(checkpoint, self, saved_cells(), self.cache)
+                    saved = time.time()
+        except BaseException:
+            if checkpoint != None:
+                # the cell split in this step is split again on resume
+                undo(first)
+                if popped != None and popped not in skipped:
+                    heap.append(popped)
+                save_checkpoint(checkpoint, self, saved_cells(), self.cache)
+                print "Build stopped, saved a checkpoint in ", checkpoint
+            raise
+        if checkpoint != None:
+            save_checkpoint(checkpoint, self, saved_cells(), self.cache)
+        error = max([0.0] + [-error for error, i in skipped])
+        if heap:
+            error = max(error, -heap[0][0])
+        print "The no. of leaves is ", leaves, " (about ", leaves*self.leaf_bytes + ranges*self.range_bytes, " bytes), the largest error left is ", error, " times the accuracy"
+
+#_______________________________________________________
+# The index of the squares (ix, iz) of the uniform 2**depth x 2**depth grid of
+# the domain in the numbering of the tree (4*parent_index + n + 1, with the
+# children n in the order BL, TL, TR, BR), i.e. the uniform array index.
+def square_index(ix, iz, depth):
+    ix, iz, depth = np.broadcast_arrays(np.asarray(ix, dtype=np.int64), iz, depth)
+    index = np.zeros(depth.shape, dtype=np.int64)
+    for level in range(np.max(depth, initial=0)):
+        bit = depth - 1 - level
+        right = (ix >> np.maximum(bit, 0)) & 1
+        top = (iz >> np.maximum(bit, 0)) & 1
+        n = np.where(right == 1, np.where(top == 1, 2, 3), np.where(top == 1, 1, 0))
+        index = np.where(bit >= 0, 4*index + n + 1, index)
+    return index
+
+# The Z-order (Morton) code of the squares (ix, iz) of a uniform grid: the
+# bits of ix and iz interleaved, ix in the even and iz in the odd bits. The
+# squares of the finest level inside a square of any level have consecutive
+# codes, from the code of its BL square on.
+def morton_code(ix, iz):
+    code = np.zeros(np.broadcast(ix, iz).shape, dtype=np.int64)
+    for shift, i in [(0, ix), (1, iz)]:
+        i = np.asarray(i, dtype=np.int64) & 0xFFFFFFFF
+        i = (i | (i << 16)) & 0x0000FFFF0000FFFF
+        i = (i | (i << 8)) & 0x00FF00FF00FF00FF
+        i = (i | (i << 4)) & 0x0F0F0F0F0F0F0F0F
+        i = (i | (i << 2)) & 0x3333333333333333
+        i = (i | (i << 1)) & 0x5555555555555555
+        code |= i << shift
+    return code
+
+# The leaves (their positions in the exported lists) of the squares (ix, iz)
+# of the uniform 2**maxdepth x 2**maxdepth grid, by a binary search of their
+# Morton codes in the map leaf_code, leaf_of of QuadTree.export()
+def finest_leaf(leaf_code, leaf_of, ix, iz):
+    return leaf_of[np.searchsorted(leaf_code, morton_code(ix, iz), side='right') - 1]
+
+# The leaves of the points (x, z) of the transformed domain, vectorized over
+# arrays of points. A point on the edge between two leaves is given the leaf
+# to its right or top, unless it is on the edge of the domain.
+def locate_leaf(leaf_code, leaf_of, maxdepth, x, z, domain=(0.0, 0.0, 1024.0, 1024.0)):
+    x0,z0,x1,z1 = domain
+    n = 2**maxdepth
+    ix = np.clip(np.floor((np.asarray(x, dtype=float) - x0)*n/(x1 - x0)), 0, n - 1).astype(np.int64)
+    iz = np.clip(np.floor((np.asarray(z, dtype=float) - z0)*n/(z1 - z0)), 0, n - 1).astype(np.int64)
+    return finest_leaf(leaf_code, leaf_of, ix, iz)
+
+# The coefficients a, b, c, d of the bilinear interpolant a + b*dx + c*dz +
+# d*dx*dz of the leaves, (dx, dz) being taken from their BL corner, from their
+# rects and the properties at their corners BL, BR, TL, TR. One contiguous
+# array (4, 9, leaves), so that interpolating is a gather and a few
+# multiply-adds per property, each of them over contiguous memory.
+def bilinear_coefficients(rect, prop):
+    w = rect[:, 2] - rect[:, 0]
+    h = rect[:, 3] - rect[:, 1]
+    q00, q10, q01, q11 = prop[:, 0].T, prop[:, 1].T, prop[:, 2].T, prop[:, 3].T
+    return np.ascontiguousarray(np.stack((q00, (q10 - q00)/w, (q01 - q00)/h, (q11 - q10 - q01 + q00)/(w*h))))
+
+#_______________________________________________________
+# The finer the dyadic grid the coordinate v is on, the higher its level:
+# -j if v is an odd multiple of 2**j
+def dyadic_level(v):
+    if v == 0:
+        return -64
+    level = 0
+    while v != math.floor(v):
+        v *= 2
+        level += 1
+    v = int(v)
+    while v % 2 == 0:
+        v //= 2
+        level -= 1
+    return level
+
+#_______________________________________________________
+# Set up of the worker processes of LinearQuadTree.subdivide_parallel(), the
+# signals are handled by the main process, which stops the workers with "stop".
+_stop = None
+
+def _init_worker(stop):
+    global _stop
+    _stop = stop
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Worker of LinearQuadTree.subdivide_parallel(), refines a single tile.
+# A failure or a stop is returned as (None, traceback) rather than raised, so
+# that the other tiles are still refined (and saved) and the pool is never
+# left waiting.
+def _subdivide_tile(job):
+    rect, rect_prop, depth, index, domain, node, accuracy, response, trans, minsize, anisotropic, cache, checkpoint, resume = job
+    try:
+        if resume and checkpoint != None and os.path.exists(checkpoint):
+            subtree, frontier, cache, tiled = load_checkpoint(checkpoint)
+        else:
+            subtree = LinearQuadTree(rect, rect_prop, depth, index, domain=domain, minsize=minsize, cache=cache, anisotropic=anisotropic)
+            frontier = [0]
+            cache.evaluations = 0 # only the evaluations of the tile are counted
+        subtree.subdivide(frontier, node, accuracy, response, trans, checkpoint=checkpoint, stop=_stop)
+    except BaseException:
+        return None, traceback.format_exc()
+    subtree.trim()
+    return subtree, cache
+
+#_______________________________________________________
+# A checkpoint of a build: the tree, the cells still to be refined, the
+# property cache and whether those cells are the tiles of a parallel build.
+# The file is replaced only once the new one is written completely.
+def save_checkpoint(checkpoint, tree, frontier, cache, tiled=False):
+    f=open(checkpoint + ".tmp", "wb" )
+    pickle.dump((tree, [int(i) for i in frontier], cache, tiled), f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(checkpoint + ".tmp", checkpoint)
+
+def load_checkpoint(checkpoint):
+    f=open(checkpoint, "rb" )
+    tree, frontier, cache, tiled = pickle.load(f)
+    f.close()
+    return tree, frontier, cache, tiled
+
+#_______________________________________________________
+# The tree (with its property cache) of an existing table, either a checkpoint
+# (see save_checkpoint) or a quad_list_leaves.pickle written by QuadTree.
+# The latter only has the leaves, so the cache is filled with their corner
+# values and the tree is rebuilt by splitting every cell that holds more than
+# one leaf, in the direction that no leaf crosses (in four if none does).
+# Corners that lie inside the edge of a larger neighbour (hanging nodes) are
+# left out and evaluated again: in balanced tables they hold the values
+# interpolated by constrain_hanging_nodes(), not the fluid properties.
+def load_table(table, rect, response, trans, spacing):
+    f=open(table, "rb" )
+    data = pickle.load(f)
+    f.close()
+    if isinstance(data[0], LinearQuadTree):
+        tree, frontier, cache, tiled = data
+        if cache.response != response:
+            raise ValueError('the table is a ' + cache.response + ' table')
+        tree.cache = cache
+        return tree
+    quad_list_unit = data[1]
+    cache = utility.VertexCache(response, trans, spacing)
+    rects = np.array([item[0] for item in quad_list_unit], dtype=float)
+    x_pts = np.column_stack((rects[:, 0], rects[:, 2], rects[:, 0], rects[:, 2])).ravel()
+    z_pts = np.column_stack((rects[:, 1], rects[:, 1], rects[:, 3], rects[:, 3])).ravel()
+    hanging = hanging_corners(cache, rects, x_pts, z_pts)
+    data = np.array([[item[1], item[2], item[4], item[3]] for item in quad_list_unit], dtype=float).reshape(-1, 9)
+    cache.store(x_pts[~hanging], z_pts[~hanging], data[~hanging])
+    hanging = len(np.unique(cache.lattice_keys(x_pts[hanging], z_pts[hanging])[0]))
+    x0,z0,x1,z1 = rect
+    tree = LinearQuadTree(rect, cache.get([x0, x1, x0, x1], [z0, z0, z1, z1]), cache=cache)
+    nodes = [0]
+    groups = [np.array([item[0] for item in quad_list_unit], dtype=float)] #the leaves in each node
+    while nodes:
+        branches = []
+        modes = []
+        for i, leaves in zip(nodes, groups):
+            if len(leaves) < 2:
+                continue
+            x0,z0,x1,z1 = tree.rect[i]
+            xm = (x0 + x1)/2
+            zm = (z0 + z1)/2
+            branches.append((i, leaves))
+            if np.any((leaves[:, 0] < xm) & (leaves[:, 2] > xm)):
+                modes.append(2)
+            elif np.any((leaves[:, 1] < zm) & (leaves[:, 3] > zm)):
+                modes.append(1)
+            else:
+                modes.append(0)
+        tree.split([i for i, leaves in branches], modes)
+        nodes = []
+        groups = []
+        for i, leaves in branches:
+            for child in tree.children(i):
+                x0,z0,x1,z1 = tree.rect[child]
+                nodes.append(child)
+                groups.append(leaves[(leaves[:, 0] >= x0) & (leaves[:, 1] >= z0) & (leaves[:, 2] <= x1) & (leaves[:, 3] <= z1)])
+    if hanging > 0:
+        print "Evaluated ", hanging, " hanging corners of ", table, " again"
+    if cache.evaluations > hanging:
+        print "Warning: ", cache.evaluations - hanging, " corner values were missing from ", table
+    return tree
+
+# Whether each of the corners x_pts, z_pts lies strictly inside an edge of one
+# of the leaves rects = [[x0, z0, x1, z1], ...]. The corners are sorted by
+# their lattice keys, x major for the vertical edges and z major for the
+# horizontal ones, so the corners inside an edge are one range of them.
+def hanging_corners(cache, rects, x_pts, z_pts):
+    hanging = np.zeros(len(x_pts), dtype=bool)
+    for along, across, edges in [(x_pts, z_pts, [(0, 1, 3), (2, 1, 3)]), (z_pts, x_pts, [(1, 0, 2), (3, 0, 2)])]:
+        keys = cache.lattice_keys(along, across)[0]
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        covered = np.zeros(len(keys) + 1, dtype=int)
+        for side, low, high in edges:
+            start = np.searchsorted(keys, cache.lattice_keys(rects[:, side], rects[:, low])[0], 'right')
+            end = np.searchsorted(keys, cache.lattice_keys(rects[:, side], rects[:, high])[0], 'left')
+            inside = start < end
+            np.add.at(covered, start[inside], 1)
+            np.add.at(covered, end[inside], -1)
+        hanging[order[np.cumsum(covered)[:-1] > 0]] = True
+    return hanging
 
-  
 #===========================================================            
 class QuadTree():
-    maxdepth = 1 # the "depth" of the tree
-    leaves = []
-    allnodes = []
-
     #_______________________________________________________
-    def __init__(self, rootnode, minrect, accuracy, response, trans):
-        Node.minsize = minrect
-        QuadTree.max_ref_level =  4
-        rootnode.subdivide(0, accuracy, response, trans) # constructs the network of nodes
-        self.prune(rootnode)
-        #index = 0
-        outputName = "quad_list_leaves.pickle"
-        quad_list = [None]*100000
-        quad_list_leaves = []
-        quad_list_index = []
-        quad_list_unit = []
-        quad_list_depth = []
-        self.traverse(rootnode, quad_list)
-        # pdb.set_trace()
-        #quad_list = quad_list[::-1]#reversing the original
-        # for count_none in range(0, len(quad_list)):
-        #     if quad_list[count_none]!= None:
-        #         break
-        #count_none =  #finding the first 'None' instance
-        # quad_list = quad_list[::-1]
-        #pdb.set_trace()
-        #act = 1000000 - count_none
-        #quad_list = quad_list[:act]
-        #quad_list[0] = rootnode.rect
+    # The cells are stored in a LinearQuadTree (self.tree), "rootnode" gives
+    # the root cell and its spans_feature() decides on the refinement, with
+    # "accuracy" in % for all the properties or for each one of them.
+    # With processes > 1 the tree is refined in parallel, the root being
+    # split into 4**tile_level tiles (see LinearQuadTree.subdivide_parallel).
+    # With "checkpoint" the build is saved to that file as it goes, and with
+    # "resume" it continues from the last checkpoint saved there.
+    # With "table" (a checkpoint or a quad_list_leaves.pickle, see load_table)
+    # an existing table is tightened to "accuracy": only its leaves that fail
+    # the new accuracy are refined, all the stored values are reused.
+    # With "max_leaves" and/or "max_bytes" the worst cells are refined first
+    # until the table has that many leaves or bytes (see
+    # LinearQuadTree.subdivide_budget), this is done in a single process.
+    # With "balanced" the finished tree is 2:1 balanced and its hanging nodes
+    # are constrained, so the interpolation is continuous across the leaves.
+    # Under a budget the tree is kept balanced as it is refined, so the
+    # balancing splits count against the budget as well.
+    # With "anisotropic" a cell may be split in one direction only (see
+    # LinearQuadTree.split_modes), which saves evaluations at tight accuracies
+    # (about 13% at 1% on rho-e) and builds the same table at loose ones.
+    # The table is written to "output", e.g. one file for each table variables.
+    # "sample_level" sets the samples of the accuracy check (see
+    # Node.sample_level), 3 checks a 7x7 instead of a 3x3 grid in every cell.
+    def __init__(self, rootnode, minrect, accuracy, response, trans, processes=1, tile_level=0, checkpoint=None, resume=False, table=None, max_leaves=None, max_bytes=None, balanced=False, anisotropic=False, output="quad_list_leaves.pickle", sample_level=2):
+        rootnode.sample_level = sample_level
+        self.maxdepth = 1 # the "depth" of the tree
+        self.leaves = []
+        self.max_ref_level =  4
+        if resume and checkpoint != None and os.path.exists(checkpoint):
+            self.tree, frontier, cache, tiled = load_checkpoint(checkpoint)
+            if cache.response != response:
+                raise ValueError('the checkpoint is a ' + cache.response + ' table')
+            self.tree.cache = cache
+            self.tree.minsize = minrect
+            self.tree.anisotropic = anisotropic
+            print "Resuming the build from ", checkpoint, " with ", self.tree.size, " cells, ", len(frontier), " left to refine"
+        elif table != None:
+            self.tree = load_table(table, rootnode.rect, response, trans, float(minrect)/2**rootnode.sample_level)
+            tree = self.tree
+            tree.minsize = minrect
+            tree.anisotropic = anisotropic
+            leaves = tree.splittable([i for i in range(tree.size) if tree.is_leaf(i)])
+            spans = tree.spans_features(leaves, rootnode, accuracy, response, trans)
+            frontier = [i for i, span in zip(leaves, spans) if span == True]
+            print "Refining ", len(frontier), " of the ", len(leaves), " leaves of ", table
+            # the failing leaves are spread over the whole domain, they are refined here
+            processes = 1
+            tiled = False
+        else:
+            # the lattice is fine enough for the samples of the smallest cells as well
+            cache = utility.VertexCache(response, trans, float(minrect)/2**rootnode.sample_level)
+            x0,z0,x1,z1 = rootnode.rect
+            cache.store([x0, x1, x0, x1], [z0, z0, z1, z1], rootnode.rect_prop)
+            self.tree = LinearQuadTree(rootnode.rect, rootnode.rect_prop, minsize=minrect, cache=cache, anisotropic=anisotropic)
+            frontier = [0]
+            tiled = False
+        rootnode.set_ranges(rootnode.rect, self.tree.cache)
+        # only the cells of a checkpoint refined to a tighter accuracy can be
+        # merged again, the cells of a new tree are split because they fail it
+        # and a quad_list_leaves.pickle has no samples to judge them by
+        built = getattr(self.tree, 'accuracy', None)
+        coarser = built != None and any([old != None and (new == None or new > old) for new, old in zip(rootnode.tolerances(accuracy), rootnode.tolerances(built))])
+        self.tree.accuracy = accuracy
+        if max_leaves != None or max_bytes != None:
+            # the leaves that fail the accuracy are those of "frontier" (the heap
+            # of a resumed build), a tiled checkpoint has them in its tiles
+            if tiled:
+                frontier = range(self.tree.size)
+            self.tree.subdivide_budget(frontier, rootnode, accuracy, response, trans, max_leaves, max_bytes, balanced, checkpoint)
+        elif processes > 1:
+            self.tree.subdivide_parallel(frontier, rootnode, accuracy, response, trans, tile_level, processes, checkpoint, resume, tiled)
+        else:
+            self.tree.subdivide(frontier, rootnode, accuracy, response, trans, checkpoint=checkpoint) # constructs the network of nodes
+        self.tree.trim()
+        self.merged = 0
+        if coarser:
+            self.prune(0, rootnode, accuracy, response, trans)
+        self.tree.compact()
+        if self.merged > 0:
+            print "Coarsened the tree, merged ", self.merged, " cells"
+        if balanced:
+            print "Balanced the tree 2:1, split ", self.tree.balance(), " cells"
+            print "Constrained ", self.tree.constrain_hanging_nodes(), " hanging nodes"
+            self.tree.trim()
+        outputName = output
+        self.export(trans)
 
         ####----------saving data in lists---------------####
-        for i,element in enumerate(QuadTree.leaves):
-            prop_list = [element.rect, element.rect_prop[0], element.rect_prop[1], element.rect_prop[3], element.rect_prop[2]]
-            quad_list_unit.append(prop_list)
-            data = [[element.rect[0],element.rect[1]], [element.rect[2],element.rect[1]], [element.rect[0],element.rect[3]], [element.rect[2],element.rect[3]]]
-            tp_data = np.ndarray.tolist(trans.inverse(data))
-            tp_data = [tp_data[0][0], tp_data[0][1], tp_data[3][0], tp_data[3][1]]
-            tp_prop_list = [tp_data, element.rect_prop[0], element.rect_prop[1], element.rect_prop[3], element.rect_prop[2]]
-            quad_list_leaves.append(tp_prop_list)
-            quad_list_index.append(element.index)
-            quad_list_depth.append(element.depth)
-        
-        ####-----------generating uniform array index -------###
-        n = 0
-        uni_old = np.zeros((1,1))
-        for n in range(QuadTree.maxdepth):
-            uni_new = np.zeros((2**(n+1), 2**(n+1)))
-            for i in range(2**n): 
-                for j in range(2**n):
-                    uni_new[2*i][2*j] = int(uni_old[i][j]*4 + 1)
-                    uni_new[(2*i)+1][2*j] = int(uni_old[i][j]*4 + 2)
-                    uni_new[(2*i)+1][(2*j)+1] = int(uni_old[i][j]*4 + 3)
-                    uni_new[2*i][(2*j)+1] = int(uni_old[i][j]*4 + 4)
-            uni_old = uni_new
-        
-        ####-----------modifying indices according to the generated quad_tree----##
-        ind_file = range(0,int(np.max(uni_old))+2)
-
-        def index_change(p_index, depth, index):
-            depth += 1
-            c1 = int((4*p_index) +1)
-            c2 = int((4*p_index) +2)
-            c3 = int((4*p_index) +3)
-            c4 = int((4*p_index) +4)
-            ind_file[c1] = index
-            ind_file[c2] = index
-            ind_file[c3] = index
-            ind_file[c4] = index
-            ch = [c1, c2, c3, c4]
-            if depth<QuadTree.maxdepth:
-                for j, child in enumerate(ch):
-                    index_change(child, depth, index)
-
-        for i, item in enumerate(quad_list_index):
-            depth = quad_list_depth[i]
-            global index
-            index = item
-            if depth<QuadTree.maxdepth:
-                index_change(item, depth, index)
+        tree = self.tree
+        rect_prop = np.ndarray.tolist(self.leaf_prop)
+        quad_list_unit = [[tuple(rect), p[0], p[1], p[3], p[2]] for rect, p in zip(np.ndarray.tolist(self.leaf_rect), rect_prop)]
+        quad_list_leaves = [[tp_data, p[0], p[1], p[3], p[2]] for tp_data, p in zip(np.ndarray.tolist(self.leaf_rect_tp), rect_prop)]
+        quad_list_index = np.ndarray.tolist(self.leaf_index)
+        quad_list_depth = np.ndarray.tolist(self.leaf_depth.astype(int))
 
         print "Sucessfully created a Tree, writing it into file."
         print "The total no. of points are: ", len(quad_list_leaves)
-        print "The tree maximum depth is: ", QuadTree.maxdepth
+        print "The tree maximum depth is: ", self.maxdepth
+        print "The no. of property evaluations: ", self.tree.cache.evaluations
+        print "The no. of leaves stopped at the minimum size or maximum depth short of the accuracy: ", self.capped(rootnode, accuracy, response, trans)
         f=open(outputName, "wb" )
-        pickle.dump((quad_list_leaves, quad_list_unit, quad_list_index, quad_list_depth, uni_old, ind_file, trans, QuadTree.maxdepth), f )
+        pickle.dump((quad_list_leaves, quad_list_unit, quad_list_index, quad_list_depth, self.leaf_code, self.leaf_of, trans, self.maxdepth), f, pickle.HIGHEST_PROTOCOL)
         f.close()
 
         ans = raw_input("Would you like to test the tree ? (Y/N): ")
@@ -185,125 +1015,125 @@ class QuadTree():
             print ("#-----Testing.. Testing... !!")
             rho_x, Eint_x = [float(x) for x in raw_input("Enter the unknown Density, Internal Energy [rho, Eint] in [Kg/m3, KJ/kg] (WITHOUT BRACES): ").split(',')]
             rho_x, Eint_x = np.ndarray.tolist(trans([rho_x, Eint_x])[0])
-            self.search(rootnode, rho_x, Eint_x)
-            
-            box = self.box
-            box_prop = self.box_prop
-            point_00 = [[box[0],box[1]], box_prop[0]]
-            point_10 = [[box[2],box[1]], box_prop[1]]
-            point_01 = [[box[0],box[3]], box_prop[2]]
-            point_11 = [[box[2],box[3]], box_prop[3]]
-
-            points = [point_00, point_10, point_01, point_11]
+            leaf = self.search(rho_x, Eint_x)
+            print "The box index as per binary search is : ", self.leaf_index[leaf]
             keyboard()
-            print self.bilinear_interpolation(rho_x, Eint_x, points)
+            print np.ndarray.tolist(self.interpolate(leaf, rho_x, Eint_x))
             ans = raw_input("Would you like to test the tree ? (Y/N): ")
 
-        # x, y = rho_x, Eint_x
         # rho_x, Eint_x = np.ndarray.tolist(trans([rho_x, Eint_x])[0])
-        # drho = 0.99999999999
-        # de   = 0.99999999999
-        # idx  = np.floor(rho_x/drho)
-        # idx  = idx.astype(int)
-        # idy  = np.floor(Eint_x/de)
-        # idy  = idy.astype(int)
+        # idx  = int(np.floor(rho_x*2**self.maxdepth/1024.0))
+        # idy  = int(np.floor(Eint_x*2**self.maxdepth/1024.0))
 
         # print "indexes are, ", idx, idy
-        # n1 = int(uni_old[idx-1][idy-1])
-        # n1 = ind_file[n1]
-        # #print "The box index as per overlap is, ", n1
-        # keyboard()
-        # n1 = [i for i,x in enumerate(quad_list_index) if x == n1][0]
+        # n1 = finest_leaf(self.leaf_code, self.leaf_of, idx, idy)
+        # #print "The box index as per overlap is, ", quad_list_index[n1]
         # data = quad_list_leaves[n1]
         # print data
 
         # keyboard()
-    def search(self, node, rho_x, Eint_x):
-        for num, child in enumerate(node.children):
-            if self.contains(child, rho_x, Eint_x):
-                if child.type == Node.LEAF:
-                    print "The box index as per binary search is : ", child.index
-                    self.box = child.rect
-                    self.box_prop = child.rect_prop
-                else:
-                    self.search(child, rho_x, Eint_x)
-
-    # A utility proc that returns True if the coordinates of
-    # a point are within the bounding box of the node.
-    def contains(self, node, x, z):
-        x0,z0,x1,z1 = node.rect
-        if x >= x0 and x <= x1 and z >= z0 and z <= z1:
-            return True
-        return False
+    # The leaves (positions in self.leaves) of the points (rho_x, Eint_x) of
+    # the transformed domain, scalars or arrays, see locate_leaf()
+    def search(self, rho_x, Eint_x):
+        return locate_leaf(self.leaf_code, self.leaf_of, self.maxdepth, rho_x, Eint_x, self.tree.domain)
     
-    def bilinear_interpolation(self, x, y, points):
-        q00=[None]*9
-        q01=[None]*9
-        q10=[None]*9
-        q11=[None]*9
-        prop_array=[]
-        for p in range(9):
-            q00[p]  = points[0][1][p]
-            x0, y0  = points[0][0]
-            q01[p]  = points[2][1][p]
-            _x0, y1 = points[2][0]
-            q10[p]  = points[1][1][p]
-            x1, _y0 = points[1][0]
-            q11[p]  = points[3][1][p]
-            _x1, _y1= points[3][0]
-
-            if x0 != _x0 or x1 != _x1 or y0 != _y0 or y1 != _y1:
-                raise ValueError('points do not form a rectangle')
-                sys.exit()
-            if not x0 <= x <= x1 or not y0 <= y <= y1:
-                raise ValueError('(x, y) not within the rectangle')
-                sys.exit()
-
-            bil = (q00[p] * (x1 - x) * (y1 - y) + q10[p] * (x - x0) * (y1 - y) + q01[p] * (x1 - x) * (y - y0) + q11[p] * (x - x0) * (y - y0)) / ((x1 - x0) * (y1 - y0) + 0.0)
-            prop_array.append(bil)
-        return prop_array
+    # The 9 properties at the points (x, z) of the transformed domain in the
+    # leaves "leaf" (see search()), from the coefficients of the leaves
+    def interpolate(self, leaf, x, z):
+        a, b, c, d = self.leaf_coef[:, :, leaf]
+        dx = x - self.leaf_rect[leaf, 0]
+        dz = z - self.leaf_rect[leaf, 1]
+        return a + dx*(b + dz*d) + dz*c
 
+    # The no. of leaves where the refinement stopped at the minimum size or
+    # the maximum depth while they still fail the accuracy. This is judged
+    # by the samples of each leaf found in the cache (for a leaf too small
+    # to be sampled, those its parent had there), nothing is evaluated; a
+    # leaf without any is not counted.
+    def capped(self, rootnode, accuracy, response, trans):
+        tree = self.tree
+        count = 0
+        for i in self.leaves:
+            if tree.depth[i] < 13 and tree.splittable([i]):
+                continue
+            rect = tuple(tree.rect[i])
+            points = rootnode.feature_points(rect)
+            found, data = tree.cache.find([point[0] for point in points], [point[1] for point in points])
+            if found and rootnode.feature_error(rect, np.ndarray.tolist(tree.prop[i]), accuracy, response, trans, data, [points[j] for j in found]) >= 1.0:
+                count += 1
+        return count
 
     #_______________________________________________________
-    # Sets children of 'node' to None if they do not have any
-    # LEAF nodes.        
-    def prune(self, node):
-        if node.type == Node.LEAF: #if it is of type leaf
+    # Coarsens the tree bottom up, for a checkpoint resumed at a looser
+    # accuracy than it was refined to: when the children of 'node' are all
+    # LEAF nodes and the bilinear reconstruction of 'node' already meets the
+    # accuracy, they are merged into 'node'. This is judged by
+    # rootnode.spans_feature() at the corners of the children and the samples
+    # of 'node', from their values in the cache of the tree; nothing is
+    # evaluated. When some of them are not stored (e.g. for a table read by
+    # load_table, or children too small to be sampled) the cells are not
+    # merged, as the corners alone miss the error of children split in one
+    # direction.
+    # Returns the number of leaves below 'node'.
+    def prune(self, node, rootnode, accuracy, response, trans):
+        tree = self.tree
+        if tree.is_leaf(node): #if it is of type leaf
             return 1
         leafcount = 0 #setting the leafcount = 0
-        removals = []
-        for child in node.children: 
-            if child != None:
-                leafcount += self.prune(child)
-                if leafcount == 0:
-                    removals.append(child)
-        # for item in removals:
-        #     n = node.children.index(item)
-        #     node.children[n] = None        
+        for child in tree.children(node):
+            leafcount += self.prune(child, rootnode, accuracy, response, trans)
+        if leafcount == tree.nchild[node] and node != 0:
+            rect = tuple(tree.rect[node])
+            x0,z0,x1,z1 = rect
+            xm = (x0 + x1)/2
+            zm = (z0 + z1)/2
+            points = [(xm, z0), (x0, zm), (x1, zm), (xm, z1)] + rootnode.feature_points(rect)
+            found, data = tree.cache.find([point[0] for point in points], [point[1] for point in points])
+            if len(found) == len(points) and not rootnode.spans_feature(rect, np.ndarray.tolist(tree.prop[node]), tree.depth[node], accuracy, response, trans, data, points):
+                tree.child[node] = -1
+                tree.nchild[node] = 0
+                self.merged += 1
+                return 1
         return leafcount
     #_______________________________________________________
-    # Appends all nodes to a "generic" list, but only LEAF 
-    # nodes are appended to the list of leaves.
-
-    def traverse(self, node, quad_list):
-        QuadTree.allnodes.append(node)
-        if (node.type == Node.LEAF):
-            QuadTree.leaves.append(node)
-            if node.depth > QuadTree.maxdepth:
-                QuadTree.maxdepth = node.depth
-        for no, child in enumerate(node.children):
-            if node.index >= 1000000:
-                print "More than what we expected, please increase the list size"
-                f=open(outputName, "wb" )
-                pickle.dump(quad_list, f )
-                f.close()
-                pdb.set_trace()
-            quad_list.insert(node.children[no].index, node.children[no].rect)
-            #quad_list.insert(node.index, new_list) #list contains all the variables
-            if node.children[no].children != [None, None, None, None]:
-                self.traverse(node.children[no], quad_list) # << recursion
-            else:
-                node.children[no].type = Node.LEAF
-                QuadTree.leaves.append(node.children[no])
-                if node.children[no].depth > QuadTree.maxdepth:
-                    QuadTree.maxdepth = node.children[no].depth
+    # The leaves of the tree as flat arrays, in one pass over the nodes: their
+    # nodes (self.leaves), rects in the unit square (self.leaf_rect) and in the
+    # table variables (self.leaf_rect_tp, BL and TR corners), the properties
+    # at the corners BL, BR, TL, TR (self.leaf_prop) and the coefficients of
+    # their interpolants (self.leaf_coef), indices and depths.
+    # The leaf of a square of the uniform grid of the finest level is found
+    # with finest_leaf() from the sorted Morton codes of the BL corners of the
+    # squares covered by the leaves (self.leaf_code) and their leaves
+    # (self.leaf_of), and the leaf of a point with locate_leaf().
+    def export(self, trans):
+        tree = self.tree
+        self.leaves = tree.leaves_below(0)
+        self.leaf_rect = tree.rect[self.leaves]
+        self.leaf_prop = tree.prop[self.leaves]
+        self.leaf_index = tree.index[self.leaves]
+        self.leaf_depth = tree.depth[self.leaves]
+        x0,z0,x1,z1 = self.leaf_rect.T
+        self.leaf_rect_tp = np.column_stack((trans.inverse(np.column_stack((x0, z0))), trans.inverse(np.column_stack((x1, z1)))))
+        self.leaf_coef = bilinear_coefficients(self.leaf_rect, self.leaf_prop)
+        self.maxdepth = max(1, int(np.max(self.leaf_depth)))
+        # the map from the squares of the finest level to the leaves: a leaf
+        # split in one direction only covers several squares of its depth, each
+        # of them covers a range of consecutive Morton codes at the finest level
+        x0,z0,x1,z1 = self.leaf_rect.T
+        side = np.minimum(x1 - x0, z1 - z0)
+        nx = np.round((x1 - x0)/side).astype(np.int64)
+        count = nx*np.round((z1 - z0)/side).astype(np.int64)
+        leaf = np.repeat(np.arange(len(self.leaves)), count)
+        k = np.arange(len(leaf)) - np.repeat(np.cumsum(count) - count, count)
+        dx0,dz0,dx1,dz1 = tree.domain
+        finest = (dx1 - dx0)/2**self.maxdepth
+        ix = np.round((x0[leaf] + (k % nx[leaf])*side[leaf] - dx0)/finest).astype(np.int64)
+        iz = np.round((z0[leaf] + (k // nx[leaf])*side[leaf] - dz0)/finest).astype(np.int64)
+        code = morton_code(ix, iz)
+        order = np.argsort(code, kind='mergesort')
+        code = code[order]
+        leaf = leaf[order]
+        # consecutive ranges of the same leaf are one range
+        first = np.concatenate(([True], leaf[1:] != leaf[:-1]))
+        self.leaf_code = code[first]
+        self.leaf_of = leaf[first].astype(np.int32)
@@ -2,7 +2,10 @@
 from quadtree import Node, QuadTree
 #from quad_plot import draw_rectangle
 import sys
+import os
+import signal
 import random
+import multiprocessing
 from pdb import set_trace as keyboard
 from matplotlib.patches import Rectangle
 import matplotlib.pyplot as plt
@@ -16,14 +19,70 @@ from skimage.transform import ProjectiveTransform
 class CNode(Node):
     #_______________________________________________________
     # Overrides the base class method.
-    # Ensures Node.subdivide() uses instances of our custom 
+    # Ensures new nodes are instances of our custom 
     # class rather than instances of the base 'Node' class.
+    # The root CNode also supplies feature_points() and spans_feature()
+    # to the tree builder (LinearQuadTree.subdivide).
     def getinstance(self, rect, rect_prop, index, n, accuracy, response, trans):
         return CNode(self, rect, rect_prop, index, n, accuracy, response, trans)
+
+    range_floor = 0.01 # see set_ranges()
+    range_level = 4 # the ranges are taken on 2**range_level+1 x 2**range_level+1 points
+    floors = [0.0]*9 # set by set_ranges()
+
+    # The errors are relative, but for a property that changes sign over the table
+    # (e, h, s through their reference states) they are taken relative to no less
+    # than range_floor times its range, so the refinement does not run away near
+    # its zero. The ranges are taken on a lattice of the table (so these values are
+    # found in the cache of the tree again when the cells are refined).
+    def set_ranges(self, rect, cache):
+        x0,z0,x1,z1 = rect
+        x_l = np.linspace(x0, x1, 2**self.range_level + 1)
+        z_l = np.linspace(z0, z1, 2**self.range_level + 1)
+        xv, zv = np.meshgrid(x_l, z_l)
+        data = cache.get(xv.ravel(), zv.ravel())
+        low = np.min(data, axis=0)
+        high = np.max(data, axis=0)
+        self.floors = np.ndarray.tolist(np.where((low < 0) & (high > 0), self.range_floor*(high - low), 0.0))
     
-    # Test if the reconstructed values are within the error limits of the acutal values, if not subdivide
-    def spans_feature(self, rect, rect_prop, depth, accuracy, response, trans):
-        x0,z0,x1,z1 = rect 
+    # The num-2 x num-2 points inside each box where the reconstructed values are tested
+    # (num = 2**sample_level + 1 points on each edge, so 3 x 3 for sample_level 2).
+    # They lie on the dyadic grid, so the centre and the
+    # other samples are again corners or samples of the children and grandchildren
+    # and their values are taken from the cache of the tree when the box is refined.
+    def feature_points(self, rect):
+        x0,z0,x1,z1 = rect
+        num = 2**self.sample_level + 1
+        del_x = (x1-x0)/(num-1.0)
+        del_z = (z1-z0)/(num-1.0)
+        x_l = np.linspace(x0+del_x,x1-del_x,num-2)
+        z_l = np.linspace(z0+del_z,z1-del_z,num-2)
+        xv = np.ndarray.flatten(np.meshgrid(x_l,z_l)[0])
+        zv = np.ndarray.flatten(np.meshgrid(x_l,z_l)[1])
+        return zip(xv, zv)
+
+    # The tolerances of the 9 properties as fractions, None for a property that is
+    # not checked. "accuracy" is either one value in % for the first 7 properties,
+    # or a list of 9 values in %, with None for the properties to leave out
+    # (e.g. looser for mu and k than for the P and T of a rho-e table).
+    # At least one property has to be checked and every tolerance is positive.
+    def tolerances(self, accuracy):
+        if np.isscalar(accuracy):
+            accuracy = [accuracy]*7 + [None]*2
+        if len(accuracy) != 9:
+            raise ValueError('the accuracy needs one value for each of the 9 properties')
+        if all([tol is None for tol in accuracy]):
+            raise ValueError('the accuracy leaves out all the properties')
+        if any([tol is not None and not tol > 0 for tol in accuracy]):
+            raise ValueError('the accuracy of every property has to be positive')
+        return [None if tol is None else tol/100.0 for tol in accuracy]
+
+    # The largest relative error of the reconstructed values at the feature_points()
+    # (or at int_points) as a multiple of its tolerance, the cell meets the accuracy
+    # when this is less than 1 (see spans_feature()). See set_ranges() for the
+    # properties that change sign.
+    def feature_error(self, rect, rect_prop, accuracy, response, trans, dataNIST=None, int_points=None):
+        x0,z0,x1,z1 = rect
 
         # dataNIST=NIST.readNIST(isoType = "isotherm", fluid = 'O2', T=x_mid, P=z_mid/1.0E6, tmin=x_mid, tmax=x_mid, pmin = z_mid/1.0E6, pmax = z_mid/1.0E6, N=1)
         
@@ -40,33 +99,35 @@ class CNode(Node):
         points = [point_00, point_10, point_01, point_11]
 
         #reconstructing property values at num x num points inside each box
-        num = 7.0
-        del_x = (x1-x0)/(num-1.0)
-        del_z = (z1-z0)/(num-1.0)
-        x_l = np.linspace(x0+del_x,x1-del_x,num-2.0)
-        z_l = np.linspace(z0+del_z,z1-del_z,num-2.0)
-        xv = np.ndarray.flatten(np.meshgrid(x_l,z_l)[0])
-        zv = np.ndarray.flatten(np.meshgrid(x_l,z_l)[1])
-
-        int_points = zip(xv, zv)
+        if int_points is None:
+            int_points = self.feature_points(rect)
+        if dataNIST is None:
+            dataNIST = [utility.get_coolprop_TPS(x_c, z_c, response, trans) for x_c, z_c in int_points]
 
-        mid_prop = [None]*25
-        dataNIST = [None]*25
+        mid_prop = [None]*len(int_points)
         for i,int_point in enumerate(int_points):
             x_c = int_point[0]
             z_c = int_point[1]
             mid_prop[i] = self.bilinear_interpolation(x_c, z_c, points, trans)
-            dataNIST[i] = utility.get_coolprop_TPS(x_c, z_c, response, trans)
 
-        glob_error = [None]*25
-        for n in range(25):
-            lc_error = [None]*7
-            for e in range(7):
-                lc_error[e] = abs(mid_prop[n][e] - dataNIST[n][e])/dataNIST[n][e]
+        tolerances = self.tolerances(accuracy)
+        checked = [e for e in range(9) if tolerances[e] != None]
+        glob_error = [None]*len(int_points)
+        for n in range(len(int_points)):
+            lc_error = [None]*len(checked)
+            for k, e in enumerate(checked):
+                lc_error[k] = abs(mid_prop[n][e] - dataNIST[n][e])/max(abs(dataNIST[n][e]), self.floors[e])/tolerances[e]
             glob_error[n] = max(lc_error)
 
+        return max(glob_error)
+
+    # Test if the reconstructed values are within the error limits of the acutal values, if not subdivide
+    # The actual values at the feature_points() can be passed in as dataNIST when
+    # they have already been evaluated (see Node.spans_features), or at other
+    # points of the rectangle given as int_points (see QuadTree.prune)
+    def spans_feature(self, rect, rect_prop, depth, accuracy, response, trans, dataNIST=None, int_points=None):
         #if all(item<(accuracy/100.0) for item in error) or depth >= 13:
-        if (max(glob_error)<(accuracy/100.0)) or depth >= 13:
+        if self.feature_error(rect, rect_prop, accuracy, response, trans, dataNIST, int_points)<1.0 or depth >= 13:
             return False
         # if depth >= 50:
         #     print error_rho, "This is the error in density"
@@ -120,75 +181,56 @@ class CNode(Node):
 
 class CQuadTree(QuadTree):
     #_______________________________________________________
-    def __init__(self, rootnode, minrect, accuracy, response, trans):
-        QuadTree.__init__(self, rootnode, minrect, accuracy, response, trans)
+    def __init__(self, rootnode, minrect, accuracy, response, trans, processes=1, tile_level=0, checkpoint=None, resume=False, table=None, max_leaves=None, max_bytes=None, balanced=False, anisotropic=False, output="quad_list_leaves.pickle", sample_level=2):
+        QuadTree.__init__(self, rootnode, minrect, accuracy, response, trans, processes, tile_level, checkpoint, resume, table, max_leaves, max_bytes, balanced, anisotropic, output, sample_level)
     
 
+#_______________________________________________________
+# The transform of the table variables in rootrect = [x_min, z_min, x_max, z_max]
+# to the square [0, 0, 1024, 1024], its corners BL, BR, TL, TR go to "dst"
+def unit_transform(rootrect, dst=[[0,0], [1024,0], [0,1024] ,[1024,1024]]):
+    trans = ProjectiveTransform()
+    src = np.asarray([[rootrect[0],rootrect[1]], [rootrect[2],rootrect[1]], [rootrect[0],rootrect[3]], [rootrect[2],rootrect[3]]])
+    if not trans.estimate(src, np.asarray(dst)):
+        raise Exception("estimate failed")
+    return trans
+
 if __name__=="__main__":
 
     print "#######################----ADAPTIVE TABULATION PROGRAM FOR THERMODYNAMIC EQUATION OF STATE------###########################"
     print "      "
-    response = raw_input("Enter the table index variables, T-P or rho-e:  ")
+    response = raw_input("Enter the table index variables, T-P, rho-e, h-P or s-P:  ")
 
     if response == "T-P":
         #T_min, T_max = [float(x) for x in raw_input("Enter the range of temperatures [T_min, T_max] in K (WITHOUT BRACES): ").split(',')]
         #P_min, P_max = [float(x) for x in raw_input("Enter the range of temperatures [P_min, P_max] in Pa: (WITHOUT BRACES) ").split(',')]
         #rootrect = [T_min, P_min, T_max, P_max]
-        rootrect = [200, 0.02E5, 600, 10.0E6]
-
-        b_left  = [rootrect[0],rootrect[1]]
-        b_right = [rootrect[2],rootrect[1]]
-        t_left  = [rootrect[0],rootrect[3]]
-        t_right = [rootrect[2],rootrect[3]]
-        raw_rootrect = rootrect
-        ### Transform to a square of dimensions [1024, 1024] ###
-        trans = ProjectiveTransform()
-        src = np.asarray([b_left, b_right, t_left, t_right])
-        dst = np.asarray([[0,0], [1023,0], [0,1023] ,[1024,1024]])
-        rootrect = [0, 0, 1024, 1024]
-        if not trans.estimate(src, dst):
-            raise Exception("estimate failed")
-            keyboard()
-
-        point_00 = [rootrect[0],rootrect[1]]
-        point_10 = [rootrect[2],rootrect[1]]
-        point_01 = [rootrect[0],rootrect[3]]
-        point_11 = [rootrect[2],rootrect[3]]
-        print("The initial rectangular domain of PT is", raw_rootrect)
-        print("The transformed domain of PT is", rootrect)
-    
-    # points = [point_00, point_10, point_01, point_11]
+        raw_rootrect = [200, 0.02E5, 600, 10.0E6]
+        trans = unit_transform(raw_rootrect, [[0,0], [1023,0], [0,1023] ,[1024,1024]])
+
     elif response == "rho-e":
         #rho_min, rho_max = [float(x) for x in raw_input("Enter the range of density [rho_min, rho_max] in Kg/m3 (WITHOUT BRACES): ").split(',')]
         #e_min, e_max = [float(x) for x in raw_input("Enter the range of energies [e_min, e_max] in J/kg: (WITHOUT BRACES) ").split(',')] 
         #rootrect = [rho_min, e_min, rho_max, rho_max]
 
         #rootrect = [0.14, -70793, 1305.20, 300000]
-        rootrect = [0.14, 50000, 130.20, 300000]
-        b_left  = [rootrect[0],rootrect[1]]
-        b_right = [rootrect[2],rootrect[1]]
-        t_left  = [rootrect[0],rootrect[3]]
-        t_right = [rootrect[2],rootrect[3]]
-        raw_rootrect = rootrect
-        ### Transform to a square of dimensions [1024, 1024] ###
-        trans = ProjectiveTransform()
-        src = np.asarray([b_left, b_right, t_left, t_right])
-        dst = np.asarray([[0,0], [1024,0], [0,1024] ,[1024,1024]])
-        rootrect = [0, 0, 1024, 1024]
-        if not trans.estimate(src, dst):
-            raise Exception("estimate failed")
-            keyboard()
-
-        point_00 = [rootrect[0],rootrect[1]]
-        point_10 = [rootrect[2],rootrect[1]]
-        point_01 = [rootrect[0],rootrect[3]]
-        point_11 = [rootrect[2],rootrect[3]]
-        print("The initial rectangular domain of PT is", raw_rootrect)
-        print("The transformed domain of PT is", rootrect)
+        raw_rootrect = [0.14, 50000, 130.20, 300000]
+        trans = unit_transform(raw_rootrect)
+
+    # inverse tables, rho, e and the other properties of (h, P) or (s, P)
+    elif response == "h-P":
+        raw_rootrect = [-150000, 0.02E5, 450000, 10.0E6]
+        trans = unit_transform(raw_rootrect)
+    elif response == "s-P":
+        raw_rootrect = [2600, 0.02E5, 7000, 10.0E6]
+        trans = unit_transform(raw_rootrect)
 
     else:
         print "The variables not recongnized !!"
         sys.exit()
+    rootrect = [0, 0, 1024, 1024]
+    print("The initial rectangular domain of " + response + " is", raw_rootrect)
+    print("The transformed domain of " + response + " is", rootrect)
     # points = [point_00, point_10, point_01, point_11]
     
     rootrect_prop = [] #the properties at those given ranges(only on 4 boundary points)
@@ -197,9 +239,44 @@ if __name__=="__main__":
 
 
     resolution = 1
-    accuracy = float(raw_input("Enter the required accuracy in (%) "))
+    processes = multiprocessing.cpu_count() #worker processes building the tree, 1 for a serial build
+    tile_level = 3 #the root is refined in parallel as 4**tile_level tiles
+    sample_level = 2 #the accuracy is checked on a 3x3 grid in every cell, 3 for a 7x7 one
+    # e.g. quad_list_leaves_hP.pickle for a h-P table next to the rho-e one
+    output = raw_input("Enter the output file (press Enter for quad_list_leaves.pickle): ")
+    if output == "":
+        output = "quad_list_leaves.pickle"
+    checkpoint = output.replace("quad_list_leaves", "quad_checkpoint") #the build is saved here as it goes
+    if checkpoint == output:
+        checkpoint = "quad_checkpoint_" + output
+    # one value, or 9 comma separated values for the properties, "-" to leave one out
+    accuracy = [None if x.strip() == "-" else float(x) for x in raw_input("Enter the required accuracy in (%) ").split(',')]
+    if len(accuracy) == 1:
+        accuracy = accuracy[0]
     rootnode = CNode(None, rootrect, rootrect_prop, 0, 0, accuracy, response, trans)
-    tree = CQuadTree(rootnode, resolution, accuracy, response, trans)
+    rootnode.tolerances(accuracy) #a wrong accuracy fails here, before anything is built
+    resume = False
+    if os.path.exists(checkpoint):
+        resume = raw_input("Resume the build saved in " + checkpoint + " ? (Y/N): ") in ['y', 'Y']
+    table = None
+    if not resume:
+        # e.g. the quad_list_leaves.pickle of a 1% table to make it a 0.1% one
+        table = raw_input("Enter an existing table to refine to this accuracy (press Enter to build a new one): ")
+        if table == "":
+            table = None
+    # the table size can be bounded instead, the worst cells are then refined first
+    max_bytes = raw_input("Enter the maximum size of the table in MB (press Enter for no limit): ")
+    if max_bytes == "":
+        max_bytes = None
+    else:
+        max_bytes = int(float(max_bytes)*1.0E6)
+    # no jumps of the interpolated values between neighbouring cells, e.g. for Newton iterations
+    balanced = raw_input("Balance the tree 2:1 for a continuous interpolation ? (Y/N): ") in ['y', 'Y']
+    # e.g. the dense liquid mostly needs a finer resolution in e
+    anisotropic = raw_input("Split the cells in one direction only where that is enough ? (Y/N): ") in ['y', 'Y']
+    # a job preemption (SIGTERM) stops the build like an exception, so it is checkpointed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("Terminated"))
+    tree = CQuadTree(rootnode, resolution, accuracy, response, trans, processes, tile_level, checkpoint, resume, table, None, max_bytes, balanced, anisotropic, output, sample_level)
     #print "Done"
     #pdb.set_trace()
     #f=open("quadtree.pickle", "wb" )